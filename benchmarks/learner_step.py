@@ -0,0 +1,76 @@
+"""
+Learner steps per second of DDQNAgent.train, against the previous implementation (three
+predict calls, a fit call and clear_session on every step).
+
+Run from the repository root with:  python -m benchmarks.learner_step
+"""
+import time
+import click
+import numpy as np
+from keras import backend as kback
+
+from src.ddqn import DDQNAgent
+
+
+def legacy_train(agent):
+    """
+    DDQNAgent.train as it was before the compiled train step.
+    """
+    batchIndexes, state, action, reward, new_state, done, batchISWeights = \
+                agent.memory.sample_buffer(agent.batch_size)
+    action_values = np.array(agent.action_space, dtype=np.int8)
+    action_indices = np.dot(action, action_values)
+
+    q_next = agent.q_target.predict(new_state, verbose=0)
+    q_eval = agent.q_eval.predict(new_state, verbose=0)
+    q_pred = agent.q_eval.predict(state, verbose=0)
+    max_actions = np.argmax(q_eval, axis=1)
+    q_target = q_pred
+
+    batch_index = np.arange(agent.batch_size, dtype=np.int32)
+    q_target[batch_index, action_indices] = reward + \
+        agent.gamma * q_next[batch_index, max_actions.astype(int)] * done
+    absError = abs(q_pred[batch_index, action_indices] - q_target[batch_index, action_indices])
+    _ = agent.q_eval.fit(state, q_target, verbose=0, sample_weight=batchISWeights)
+
+    agent.memory.batchUpdate(batchIndexes, absError)
+    agent.update_epsilon()
+    agent.epsilon_step += 1
+    kback.clear_session()
+
+
+def filled_agent(transitions, seed=0):
+    rng = np.random.default_rng(seed)
+    agent = DDQNAgent(alpha=0.0005, gamma=0.95, n_actions=9, epsilon=1.0, batch_size=64, input_dims=12)
+    state = rng.random(12)
+    for i in range(transitions):
+        new_state = rng.random(12)
+        agent.remember(state, int(rng.integers(9)), -1.0, new_state, i % 200 == 199)
+        state = new_state
+    return agent
+
+
+def steps_per_second(train, agent, steps, warmup=5):
+    for _ in range(warmup):
+        train(agent)
+    start = time.perf_counter()
+    for _ in range(steps):
+        train(agent)
+    return steps / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--steps', default=200, help='Timed learner steps per implementation.')
+def main(steps):
+    agent = filled_agent(5000)
+    legacy = steps_per_second(legacy_train, agent, steps)
+    agent = filled_agent(5000)
+    fused = steps_per_second(DDQNAgent.train, agent, steps)
+
+    print(f"legacy train (3x predict + fit + clear_session): {legacy:8.1f} steps/s")
+    print(f"compiled train step:                             {fused:8.1f} steps/s")
+    print(f"speedup: {fused / legacy:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+"""
+Micro-benchmarks of the simulation and learning hot paths, each timed in isolation over
+fixed, seeded inputs. Runs headless (no window is opened).
+
+Run from the repository root:
+    python -m benchmarks.suite run --output bench_output.json
+    python -m benchmarks.suite run -k sumtree          # only benchmarks matching a pattern
+    python -m benchmarks.suite compare baseline.json bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import click
+import numpy as np
+import pygame
+
+from src.Cars import PlayerCar
+from src.RewardGates import RewardGate
+from src.Environment import Environment, load_track_border
+from src.VecEnvironment import VecEnvironment
+from src.Sensor import Sensor, DistanceFieldSensor
+from src.SumTree import SumTree
+from src.ExperienceReplay import PrioritisedMemory
+from src.utils import surface_to_grid
+
+N_INPUTS = 256 # Inputs cycled through by each benchmark
+BENCHMARKS = {} # name -> setup(fixtures) returning the function to time
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class Fixtures:
+    """
+    Inputs shared between benchmarks, created on first use from a fixed seed.
+    """
+    def __init__(self, seed):
+        self.seed = seed
+        self._cache = {}
+
+    def cached(self, name, create):
+        if name not in self._cache:
+            self._cache[name] = create()
+        return self._cache[name]
+
+    def rng(self):
+        return np.random.default_rng(self.seed)
+
+    @property
+    def track_border(self):
+        return self.cached('track_border', load_track_border)
+
+    @property
+    def track_border_mask(self):
+        return self.cached('track_border_mask', lambda: pygame.mask.from_surface(self.track_border))
+
+    @property
+    def poses(self):
+        """
+        Car poses (x, y, angle) on pixels clear of the track border.
+        """
+        def create():
+            free = np.argwhere(~surface_to_grid(self.track_border))
+            rng = self.rng()
+            y, x = free[rng.integers(len(free), size=N_INPUTS)].T
+            return np.column_stack([x + rng.random(N_INPUTS), y + rng.random(N_INPUTS),
+                                    rng.uniform(-360, 360, N_INPUTS)])
+        return self.cached('poses', create)
+
+    @property
+    def car(self):
+        return self.cached('car', lambda: PlayerCar(8, 5))
+
+    @property
+    def posed_cars(self):
+        """
+        The rotated mask and position of the car at each pose.
+        """
+        def create():
+            car, posed = self.car, []
+            for x, y, angle in self.poses:
+                car.x, car.y, car.angle = x, y, angle
+                car.update_car_img()
+                posed.append((car.rot_mask, car.rot_x, car.rot_y))
+            car.reset()
+            return posed
+        return self.cached('posed_cars', create)
+
+    @property
+    def states(self):
+        return self.cached('states', lambda: self.rng().random((N_INPUTS, 12)) * 100)
+
+    def memory(self, capacity=100000, transitions=100000):
+        """
+        A PrioritisedMemory filled with seeded transitions and priorities.
+        """
+        rng = self.rng()
+        memory = PrioritisedMemory(capacity, 12, 9, True)
+        states = rng.random((transitions + 1, 12))
+        for i in range(transitions):
+            memory.store_transition(states[i], int(rng.integers(9)), -1.0, states[i + 1], False)
+        leaves = np.arange(min(transitions, capacity)) + memory.sumTree.indexOfFirstData
+        memory.batchUpdate(leaves, rng.random(len(leaves)))
+        return memory
+
+
+def cycle(inputs, call):
+    """
+    Function calling call on the next of inputs each time it is called.
+    """
+    index = [0]
+    n = len(inputs)
+    def run():
+        i = index[0]
+        index[0] = (i + 1) % n
+        return call(inputs[i])
+    return run
+
+
+def pose_car(car, pose):
+    car.x, car.y, car.angle = pose
+    return car
+
+
+@benchmark('sensor.beam_distances')
+def sensor_beam_distances(fixtures):
+    sensor = Sensor(fixtures.track_border, fixtures.track_border, debug=False)
+    car = fixtures.car
+    return cycle(fixtures.poses, lambda pose: sensor.beam_distances(pose_car(car, pose)))
+
+
+@benchmark('sensor.distance_field.beam_distances')
+def distance_field_beam_distances(fixtures):
+    sensor = DistanceFieldSensor(fixtures.track_border)
+    car = fixtures.car
+    return cycle(fixtures.poses, lambda pose: sensor.beam_distances(pose_car(car, pose)))
+
+
+def collide_with(car, mask):
+    def call(posed):
+        car.rot_mask, car.rot_x, car.rot_y = posed
+        return car.collide(mask)
+    return call
+
+
+@benchmark('car.collide.border')
+def car_collide_border(fixtures):
+    return cycle(fixtures.posed_cars, collide_with(fixtures.car, fixtures.track_border_mask))
+
+
+@benchmark('car.collide.gates')
+def car_collide_gates(fixtures):
+    gate_masks = RewardGate().reward_gate_masks
+    car = fixtures.car
+    inputs = [(posed, gate_masks[i % len(gate_masks)]) for i, posed in enumerate(fixtures.posed_cars)]
+    return cycle(inputs, lambda item: collide_with(car, item[1])(item[0]))
+
+
+@benchmark('car.update_car_img')
+def car_update_car_img(fixtures):
+    car = fixtures.car
+    return cycle(fixtures.poses, lambda pose: pose_car(car, pose).update_car_img())
+
+
+@benchmark('reward_gate.distance_and_angle')
+def reward_gate_distance_and_angle(fixtures):
+    gates = RewardGate()
+    def call(pose):
+        gates.active_gate = int(pose[2]) % gates.no_of_gates
+        return gates.distance_to_gate(pose[0], pose[1]), gates.angle_to_gate(pose[0], pose[1])
+    return cycle(fixtures.poses, call)
+
+
+@benchmark('environment.game_loop_and_state')
+def environment_game_loop_and_state(fixtures):
+    # Game.game_loop/game_state are those of Environment, which needs no window
+    env = Environment(fixtures.track_border, sensors='mask')
+    env.game_reset()
+    actions = fixtures.rng().integers(1, 10, N_INPUTS)
+    def call(action_no):
+        env.game_loop(action_no)
+        _, _, done = env.game_state()
+        if done:
+            env.game_reset()
+    return cycle(actions, call)
+
+
+@benchmark('vec_environment.step')
+def vec_environment_step(fixtures):
+    # One call steps all 64 cars, so divide by 64 to compare with environment.game_loop_and_state
+    env = VecEnvironment(64)
+    env.reset()
+    actions = fixtures.rng().integers(9, size=(N_INPUTS, 64))
+    return cycle(actions, env.step)
+
+
+@benchmark('sumtree.getLeaf')
+def sumtree_get_leaf(fixtures):
+    tree = fixtures.cached('memory', fixtures.memory).sumTree
+    values = fixtures.rng().random(N_INPUTS) * tree.total_priority()
+    return cycle(values, tree.getLeaf)
+
+
+@benchmark('sumtree.update')
+def sumtree_update(fixtures):
+    tree = SumTree(100000)
+    rng = fixtures.rng()
+    inputs = list(zip(rng.integers(100000, size=N_INPUTS) + tree.indexOfFirstData, rng.random(N_INPUTS)))
+    return cycle(inputs, lambda item: tree.update(*item))
+
+
+@benchmark('memory.sample_buffer')
+def memory_sample_buffer(fixtures):
+    memory = fixtures.cached('memory', fixtures.memory)
+    np.random.seed(fixtures.seed)
+    return lambda: memory.sample_buffer(64)
+
+
+@benchmark('memory.batchUpdate')
+def memory_batch_update(fixtures):
+    memory = fixtures.cached('memory', fixtures.memory)
+    rng = fixtures.rng()
+    inputs = [(rng.integers(memory.mem_size, size=64) + memory.sumTree.indexOfFirstData, rng.random(64))
+              for _ in range(N_INPUTS)]
+    return cycle(inputs, lambda item: memory.batchUpdate(*item))
+
+
+def agent(fixtures):
+    from src.ddqn import DDQNAgent # TensorFlow is only needed by the agent benchmarks
+
+    def create():
+        ddqn_agent = DDQNAgent(alpha=0.0005, gamma=0.95, n_actions=9, epsilon=1.0, batch_size=64,
+                               input_dims=12, mem_size=100000)
+        ddqn_agent.memory = fixtures.memory()
+        return ddqn_agent
+    return fixtures.cached('agent', create)
+
+
+@benchmark('agent.choose_action')
+def agent_choose_action(fixtures):
+    ddqn_agent = agent(fixtures)
+    return cycle(fixtures.states, ddqn_agent.choose_action)
+
+
+@benchmark('agent.train')
+def agent_train(fixtures):
+    ddqn_agent = agent(fixtures)
+    np.random.seed(fixtures.seed)
+    return ddqn_agent.train
+
+
+def time_call(call, rounds, round_time):
+    """
+    Per-call times (in microseconds) of call, one for each round. The number of calls
+    per round is calibrated so that each round takes about round_time seconds.
+    """
+    call() # Warm up (caches, graph tracing)
+    start = time.perf_counter()
+    calls = 0
+    while time.perf_counter() - start < round_time / 10:
+        call()
+        calls += 1
+    per_call = (time.perf_counter() - start) / calls
+    number = max(1, int(round_time / per_call))
+
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        times.append((time.perf_counter() - start) / number * 1e6)
+    return times, number
+
+
+def run_benchmarks(names, seed, rounds, round_time):
+    fixtures = Fixtures(seed)
+    results = {}
+    for name in names:
+        call = BENCHMARKS[name](fixtures)
+        times, number = time_call(call, rounds, round_time)
+        results[name] = {'median_us': statistics.median(times), 'min_us': min(times),
+                         'stdev_us': statistics.stdev(times) if len(times) > 1 else 0.0,
+                         'rounds': rounds, 'calls_per_round': number}
+        print(f"{name:40s} {results[name]['median_us']:12.2f} us  (min {results[name]['min_us']:.2f})")
+    return results
+
+
+def compare_results(baseline, current, threshold):
+    """
+    Print the change in median time of each benchmark. Returns the names of those that
+    are slower than the baseline by more than threshold (a fraction).
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print(f"{name:40s} {result['median_us']:12.2f} us  (no baseline)")
+            continue
+        before = baseline['results'][name]['median_us']
+        change = result['median_us'] / before - 1
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = 'improved'
+        print(f"{name:40s} {before:12.2f} -> {result['median_us']:12.2f} us  {change:+7.1%}  {flag}")
+    return regressions
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('-k', 'pattern', default='', help='Only run benchmarks whose name contains this.')
+@click.option('--output', default='bench_output.json', help='JSON file to save the results to.')
+@click.option('--seed', default=0)
+@click.option('--rounds', default=5, help='Timed rounds per benchmark.')
+@click.option('--round-time', default=0.2, help='Approximate duration of each round (seconds).')
+@click.option('--baseline', default=None, help='Compare against the results in this JSON file.')
+@click.option('--threshold', default=0.2, help='Slowdown (fraction) counted as a regression.')
+def run(pattern, output, seed, rounds, round_time, baseline, threshold):
+    names = [name for name in BENCHMARKS if pattern in name]
+    results = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed,
+                        'python': platform.python_version(), 'numpy': np.__version__,
+                        'pygame': pygame.version.ver, 'machine': platform.machine(),
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+               'results': run_benchmarks(names, seed, rounds, round_time)}
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved results to {output}")
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare_results(json.load(f), results, threshold)
+        sys.exit(1 if regressions else 0)
+
+
+@cli.command()
+@click.argument('baseline')
+@click.argument('current', default='bench_output.json')
+@click.option('--threshold', default=0.2, help='Slowdown (fraction) counted as a regression.')
+def compare(baseline, current, threshold):
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,10 +1,22 @@
+import os
+import json
+import time
 import pygame
 import click
 import numpy as np
-import gc
-
-from src.ddqn import DDQNAgent
-from src.Game import Game
+from types import SimpleNamespace
+
+from src.Policy import NumpyPolicy
+from src.Scheduler import TrainingScheduler
+from src.Profiling import PROFILER
+from src.Metrics import MetricsLog
+from src.Environment import Environment, load_track_border
+from src.Sensor import Sensor, DistanceFieldSensor, BakedSensor, bake_sensor_table
+from src.Cars import PlayerCar
+from src.Assets import ASSET_BUNDLE, compile_assets
+from src.Trajectory import (TRAJECTORY, EXPECTATIONS, TrajectoryWriter, Trajectory, default_recording,
+                            load_recording, replay, first_divergence)
+from src.Checkpoint import atomic_write
 
 FPS = 30
 
@@ -14,12 +26,13 @@ def cli():
 
 
 @cli.command()
-def manual():
-    game = Game()
+@click.option('--show-beams', is_flag=True, help='Draw the sensor beams (for debugging).')
+def manual(show_beams):
+    from src.Game import Game # Opens the game window on import
+    game = Game(show_beams)
     clock = pygame.time.Clock()
 
-    game.draw()
-    pygame.display.update()
+    pygame.display.update(game.draw())
 
     run = True
     while run:
@@ -29,55 +42,99 @@ def manual():
         run = game.manual_loop()
         _ = game.game_state()
 
-        game.draw()
-        pygame.display.update()
+        pygame.display.update(game.draw())
 
     pygame.quit()
 
 
 @cli.command()
-def train():
-    game = Game()
-    pygame.event.set_allowed([pygame.QUIT])
+@click.option('--sensors', type=click.Choice(['mask', 'distance_field', 'baked']), default='mask',
+              help='Beam sensor backend used for the model input. test, record and playback use mask, so '
+                   'run check-sensors before training with one of the faster backends.')
+@click.option('--memory', type=click.Choice(['full', 'compact', 'quantized']), default='full',
+              help='Replay storage - compact keeps one float32 copy of each state, quantized '
+                   'uses float16. Saved buffers can only be resumed with the same layout.')
+@click.option('--storage', type=click.Choice(['ram', 'memmap']), default='ram',
+              help='Hold the replay memory in RAM, or in memory-mapped files under model/replay '
+                   '(resumes instantly and can be larger than RAM).')
+@click.option('--mem-size', default=100000, help='Capacity of the replay memory.')
+@click.option('--actors', default=0,
+              help='Number of actor processes collecting experience for the learner (0 to act and '
+                   'learn in turn in this process).')
+@click.option('--train-every', default=1, help='Environment steps per train call.')
+@click.option('--gradient-steps', default=1,
+              help='Learner steps per train call (sampled together as one stacked batch).')
+@click.option('--warmup', default=0, help='Transitions to collect before training starts.')
+@click.option('--target-sync', default=0,
+              help='Learner steps between target network updates (0 to update every 1000 stored transitions).')
+@click.option('--prefetch', default=0,
+              help='Batches to sample ahead on a background thread (0 to sample inline).')
+@click.option('--profile', is_flag=True, help='Print the time spent in each phase of the loop after every episode.')
+@click.option('--metrics/--no-metrics', default=True,
+              help='Log the metrics of every episode to model/metrics/metrics-NNN.jsonl.')
+def train(sensors, memory, storage, mem_size, actors, train_every, gradient_steps, warmup, target_sync,
+          prefetch, profile, metrics):
+    from src.ddqn import DDQNAgent # Imports TensorFlow, which the other commands do not need
+    PROFILER.enabled = profile
+    metrics = MetricsLog('model/metrics') if metrics else None
 
     ddqn_agent = DDQNAgent(alpha=0.0005, gamma=0.95, n_actions=9, epsilon=1.0, batch_size=64, input_dims=12, 
-                           fname='model/ddqn_model.h5', parameter_fname = 'model/ddqn_model')
+                           fname='model/ddqn_model.h5', parameter_fname = 'model/ddqn_model',
+                           replace_target=None if target_sync else 1000,
+                           compact_memory=memory != 'full',
+                           state_dtype=np.float16 if memory == 'quantized' else np.float32,
+                           mem_size=mem_size, memory_dir='model/replay' if storage == 'memmap' else None,
+                           checkpoint_dir='model/ddqn_model_checkpoint' if storage == 'ram' else None,
+                           prefetch=prefetch)
 
     # Train Model
     current_ep = 0
     n_games = 10000
     max_steps = 3600
     current_ep = ddqn_agent.load_model()
+    scheduler = TrainingScheduler(train_every, gradient_steps, warmup, target_sync)
+
+    if actors > 0:
+        train_with_actors(ddqn_agent, scheduler, actors, current_ep, n_games,
+                          dict(sensors=sensors), metrics)
+        return
+
+    # Train headless - no window, event pump or drawing, and a simulated game clock
+    env = Environment(sensors=sensors)
 
     while current_ep <= n_games:
         score = 0
         lifespan_ = 0
-        game.game_reset()
-        game_state, reward, done = game.game_state()
+        game_state = env.reset()
         steps = 0
 
         while steps < max_steps:
             lifespan = lifespan_
             lifespan_ += 1
-            action = ddqn_agent.choose_action_train(game_state)
-            game.game_loop(action+1)
-            game_state_, reward, done = game.game_state()
+            with PROFILER.phase('act'):
+                action = ddqn_agent.choose_action_train(game_state)
+            with PROFILER.phase('env.step'):
+                game_state_, reward, done = env.step(action)
             score += reward
-            ddqn_agent.remember(game_state, action, reward, game_state_, done)
+            with PROFILER.phase('remember'):
+                ddqn_agent.remember(game_state, action, reward, game_state_, done)
             game_state = game_state_
-            ddqn_agent.train()
-            running = game.check_exit()
-            if done or not(running): # End episode if car crashed
+            scheduler.observe()
+            with PROFILER.phase('train'):
+                scheduler.train(ddqn_agent)
+            if done: # End episode if car crashed
                 steps = max_steps
             steps += 1
 
-        if not(running):
-            break
-        
-        print(f'Episode finished with {game.gate_count} reward gates passed.')
+        print(f'Episode finished with {env.gate_count} reward gates passed.')
         print('Episode no ', current_ep, 'score %.2f' % score, 'lifespan ', lifespan)
-        
-        gc.collect()
+        rates = scheduler.rates()
+        print('%.0f env steps/s, %.0f learner steps/s' % rates)
+        if PROFILER.enabled:
+            print(PROFILER.report())
+        if metrics is not None:
+            log_episode(metrics, ddqn_agent, rates, ddqn_agent.take_train_stats(), episode=current_ep,
+                        score=score, lifespan=lifespan, gate_count=env.gate_count)
             
         if current_ep % 25 == 0:
             ddqn_agent.save_model(current_ep)
@@ -85,29 +142,90 @@ def train():
 
         current_ep += 1
 
-    pygame.quit()
+
+def log_episode(metrics, ddqn_agent, rates, train_stats, **episode):
+    """
+    Add a record of a finished episode, plus the state of the agent, the step rates and
+    the learner (loss, td_error) statistics, to the metrics log.
+    """
+    loss, td_error = train_stats
+    metrics.log(**episode, epsilon=ddqn_agent.epsilon, epsilon_step=ddqn_agent.epsilon_step,
+                mem_count=ddqn_agent.memory.mem_count, loss=loss, td_error=td_error,
+                beta=ddqn_agent.memory.b, env_steps_per_s=rates[0], learner_steps_per_s=rates[1])
+
+
+def train_with_actors(ddqn_agent, scheduler, n_actors, current_ep, n_games, env_kwargs, metrics=None,
+                      publish_every=25):
+    """
+    Learner side of train --actors. Actor processes run the environment and send their
+    transitions here, where they are stored in the agent's memory and learned from (as
+    often as the scheduler allows). The updated q_eval weights are published to the
+    actors every publish_every learner steps. Finished episodes are logged to metrics
+    (a MetricsLog, or None).
+    """
+    from src.Actors import ActorPool
+
+    pool = ActorPool(n_actors, ddqn_agent.q_eval.get_weights(), env_kwargs)
+    published = ddqn_agent.epsilon_step
+    try:
+        while current_ep <= n_games:
+            finished = []
+            with PROFILER.phase('collect'):
+                batches = pool.collect(block=scheduler.due() <= 0) # Wait for data if no training is due
+            for batch in batches:
+                with PROFILER.phase('remember'):
+                    for transition in zip(batch['states'], batch['actions'], batch['rewards'],
+                                          batch['new_states'], batch['dones']):
+                        ddqn_agent.remember(*transition)
+                scheduler.observe(len(batch['actions']))
+
+                for score, gates, steps in batch['episodes']:
+                    print(f"Actor {batch['actor_id']} episode finished with {gates} reward gates passed.")
+                    print('Episode no ', current_ep, 'score %.2f' % score, 'lifespan ', steps - 1)
+                    if current_ep % 25 == 0:
+                        ddqn_agent.save_model(current_ep)
+                        print(f"Saved model after {ddqn_agent.epsilon_step} training steps <- episode {current_ep}")
+                    finished.append(dict(episode=current_ep, actor_id=batch['actor_id'], score=score,
+                                         lifespan=steps - 1, gate_count=gates))
+                    current_ep += 1
+            if finished:
+                rates = scheduler.rates()
+                print('%.0f env steps/s, %.0f learner steps/s' % rates)
+                if PROFILER.enabled:
+                    print(PROFILER.report())
+                if metrics is not None:
+                    train_stats = ddqn_agent.take_train_stats() # Shared by the episodes that finished together
+                    for episode in finished:
+                        log_episode(metrics, ddqn_agent, rates, train_stats, **episode)
+
+            with PROFILER.phase('train'):
+                scheduler.train(ddqn_agent, limit=1)
+            if ddqn_agent.epsilon_step - published >= publish_every:
+                pool.publish(ddqn_agent.q_eval.get_weights())
+                published = ddqn_agent.epsilon_step
+    finally:
+        pool.close()
 
 
 @cli.command()
-def test():
+@click.option('--show-beams', is_flag=True, help='Draw the sensor beams (for debugging).')
+def test(show_beams):
     # Test model
-    game = Game()
+    from src.Game import Game # Opens the game window on import
+    game = Game(show_beams)
     pygame.event.set_allowed([pygame.QUIT])
 
-    ddqn_agent = DDQNAgent(alpha=0.0005, gamma=0.95, n_actions=9, epsilon=1.0, batch_size=64, input_dims=12, 
-                           fname='model/ddqn_model.h5', parameter_fname = 'model/ddqn_model')
+    policy = NumpyPolicy.from_h5('model/ddqn_model.h5')
     game.game_reset()
     game_state, _, done = game.game_state()
 
     clock = pygame.time.Clock()
-    _ = ddqn_agent.load_model()
-    game.draw()
-    pygame.display.update()
+    pygame.display.update(game.draw())
 
     run = True
     while run:
         clock.tick(FPS)
-        action = ddqn_agent.choose_action(game_state)
+        action = policy.choose_action(game_state)
         game.game_loop(action+1)
         game_state, _, done = game.game_state()
         run = game.check_exit()
@@ -115,75 +233,116 @@ def test():
             print(f'Attempt finished with {game.gate_count} reward gates passed.')
             game.game_reset()
             game_state, _, done = game.game_state()
-        game.draw()
-        pygame.display.update()
+        pygame.display.update(game.draw())
     pygame.quit()
 
 
 @cli.command()
-def record():
+@click.option('--output', default=TRAJECTORY, help='Trajectory file to record to.')
+@click.option('--episodes', default=1, help='Number of attempts to record.')
+def record(output, episodes):
     # Record the steps that are taken by a model for replay later
+    from src.Game import Game # Opens the game window on import
     game = Game()
     pygame.event.set_allowed([pygame.QUIT])
 
-    ddqn_agent = DDQNAgent(alpha=0.0005, gamma=0.95, n_actions=9, epsilon=1.0, batch_size=64, input_dims=12, 
-                           fname='model/ddqn_model.h5', parameter_fname = 'model/ddqn_model')
+    policy = NumpyPolicy.from_h5('model/ddqn_model.h5')
     game.game_reset()
     game_state, _, done = game.game_state()
 
     clock = pygame.time.Clock()
-    _ = ddqn_agent.load_model()
     steps = 0
     max_steps = 3600
-    actions = []
-    game.draw()
-    pygame.display.update()
+    writer = TrajectoryWriter(output, len(game_state))
+    pygame.display.update(game.draw())
 
     run = True
-    while run:
-        clock.tick(FPS)
-        action = ddqn_agent.choose_action(game_state)
-        actions.append(action)
-        game.game_loop(action+1)
-        game_state, _, done = game.game_state()
-        steps += 1
-        
-        game.draw()
-        pygame.display.update()
+    try:
+        while run:
+            clock.tick(FPS)
+            action = policy.choose_action(game_state)
+            snapshot = game.snapshot()
+            game.game_loop(action+1)
+            new_game_state, reward, done = game.game_state()
+            writer.append(snapshot, game_state, action, reward, done)
+            game_state = new_game_state
+            steps += 1
 
-        run = game.check_exit()
-        if done or (steps > max_steps): # End episode if car crashed
-            print(f'Attempt finished with {game.gate_count} reward gates passed, after {steps} steps.')
-            break
-    np.save('model/action_save', actions)
+            pygame.display.update(game.draw())
+
+            run = game.check_exit()
+            if done or (steps > max_steps): # End episode if car crashed
+                print(f'Attempt finished with {game.gate_count} reward gates passed, after {steps} steps.')
+                writer.end_episode()
+                if writer.episode == episodes:
+                    break
+                game.game_reset()
+                game_state, _, done = game.game_state()
+                steps = 0
+    finally:
+        writer.close()
     pygame.quit()
 
 
 @cli.command()
-def playback():
+@click.option('--recording', multiple=True,
+              help='Trajectory file from record, or a .npy file of actions (from before trajectories). '
+                   'Can be given more than once with --headless. Defaults to model/trajectory.bin (or '
+                   'model/action_save.npy if nothing has been recorded), or with --verify every recording '
+                   'in model/playback_expectations.json.')
+@click.option('--episode', default=0, help='Recorded episode to play back.')
+@click.option('--start', default=0, help='Step to start playing back from.')
+@click.option('--headless', is_flag=True,
+              help='Re-simulate every episode of the recordings as fast as possible, with no window.')
+@click.option('--verify', is_flag=True,
+              help='With --headless, check each step against the recording and the outcome against '
+                   'model/playback_expectations.json, failing at the first step that differs.')
+@click.option('--check-inputs', is_flag=True,
+              help='With --verify, also recompute and compare the model input of every step (much slower, '
+                   'as the beam sensors are run).')
+@click.option('--update', is_flag=True,
+              help='With --headless, store the outcomes in model/playback_expectations.json as the expected ones.')
+def playback(recording, episode, start, headless, verify, check_inputs, update):
+    if headless:
+        playback_headless(recording, verify, check_inputs, update)
+        return
+    if len(recording) > 1:
+        raise click.UsageError('Only one recording can be played back in the window.')
+    recording = recording[0] if recording else default_recording()
+
     # Playback a pre-recorded game
+    from src.Game import Game # Opens the game window on import
     game = Game()
     pygame.event.set_allowed([pygame.QUIT])
 
     game.game_reset()
+    if recording.endswith('.npy'):
+        # Only the actions were recorded, so the steps before start have to be replayed
+        actions = np.load(recording)
+        for action in actions[:start]:
+            game.game_loop(action+1)
+            game.game_state()
+    else:
+        # Seek straight to the start step by restoring the recorded game state
+        records = Trajectory(recording).episode(episode)
+        actions = records['action']
+        if start < len(records):
+            game.restore(records[start])
     _ = game.game_state()
 
     clock = pygame.time.Clock()
 
-    steps = 0
-    actions = np.load('model/action_save.npy')
-    game.draw()
-    pygame.display.update()
+    steps = start
+    pygame.display.update(game.draw())
 
-    run = True
+    run = steps < len(actions)
     while run:
         clock.tick(FPS)
         action = actions[steps]
         game.game_loop(action+1)
         _ = game.game_state()
         steps += 1
-        game.draw()
-        pygame.display.update()
+        pygame.display.update(game.draw())
         run = game.check_exit()
         if steps == len(actions):
             print(f'Attempt finished with {game.gate_count} reward gates passed, after {steps} steps.')
@@ -191,5 +350,104 @@ def playback():
     pygame.quit()
 
 
+def playback_headless(recordings, verify, check_inputs, update):
+    """
+    Re-simulate recordings without a window or frame clock. With verify, every step of a
+    trajectory is compared with what was recorded, and the outcome of each episode with
+    the one stored in EXPECTATIONS. Exits with an error if any recording diverged.
+    """
+    expectations = {}
+    if os.path.exists(EXPECTATIONS):
+        with open(EXPECTATIONS) as f:
+            expectations = json.load(f)
+    if not recordings:
+        recordings = sorted(expectations) if verify else [default_recording()]
+        if not recordings:
+            raise click.UsageError(f'Nothing to verify - {EXPECTATIONS} holds no expected outcomes. '
+                                   'Pass --recording, or store outcomes with --headless --update.')
+
+    env = Environment()
+    failures = 0
+    for fname in recordings:
+        outcomes = []
+        for i, (actions, records) in enumerate(load_recording(fname)):
+            start_time = time.perf_counter()
+            outcome, mismatch = replay(env, actions, records if verify else None, inputs=check_inputs)
+            rate = outcome['steps'] / max(time.perf_counter() - start_time, 1e-9)
+            outcomes.append(outcome)
+
+            expected = expectations.get(fname, [])
+            if verify and mismatch is None and i < len(expected):
+                mismatch = first_divergence(expected[i], outcome)
+            if verify and records is None and i >= len(expected):
+                mismatch = (0, 'no expected outcome stored (see --update)')
+            result = f"{fname} episode {i}: {outcome['steps']} steps, {outcome['gate_count']} gates " \
+                     f"({rate:.0f} steps/s)"
+            if mismatch is not None:
+                failures += 1
+                print(f"{result} - diverged at step {mismatch[0]}: {mismatch[1]}")
+            else:
+                print(result + (' - OK' if verify else ''))
+        if update:
+            expectations[fname] = outcomes
+
+    if update:
+        atomic_write(EXPECTATIONS, lambda f: f.write(json.dumps(expectations, indent=1).encode()))
+        print(f'Saved the outcomes of {len(recordings)} recording(s) to {EXPECTATIONS}.')
+    if failures:
+        raise SystemExit(f'{failures} episode(s) diverged from their recording.')
+
+
+@cli.command('check-sensors')
+@click.option('--samples', default=2000, help='Number of random car poses to compare.')
+@click.option('--tolerance', default=1.5, help='Largest allowed difference in beam distance (px).')
+@click.option('--seed', default=0)
+@click.option('--backend', type=click.Choice(['distance_field', 'baked']), default='distance_field',
+              help='Sensor backend to compare against the mask sensors.')
+def check_sensors(samples, tolerance, seed, backend):
+    # Check a faster sensor backend gives the same beam distances as the mask sensors
+    track_border = load_track_border()
+    mask_sensors = Sensor(track_border, track_border, debug=False)
+    field_sensors = DistanceFieldSensor(track_border)
+    sensors = BakedSensor(track_border) if backend == 'baked' else field_sensors
+
+    # Random poses anywhere clear of the border
+    rng = np.random.default_rng(seed)
+    ys, xs = np.nonzero(field_sensors.distance_field >= 3)
+    picks = rng.integers(len(xs), size=samples)
+    poses = zip(xs[picks] + rng.random(samples), ys[picks] + rng.random(samples), rng.uniform(0, 360, samples))
+
+    errors = []
+    for x, y, angle in poses:
+        car = SimpleNamespace(x=x, y=y, angle=angle)
+        expected = mask_sensors.beam_distances(car)
+        if None in expected: # Beam left the window without hitting the border
+            continue
+        errors.append(np.abs(np.array(sensors.beam_distances(car)) - expected))
+
+    errors = np.array(errors)
+    print(f'Compared {errors.size} beams from {len(errors)} poses.')
+    print(f'Max difference {errors.max():.1f}px, 99th percentile {np.percentile(errors, 99):.1f}px, '
+          f'mean {errors.mean():.2f}px, {100 * np.mean(errors <= 1):.2f}% within 1px.')
+    if errors.max() > tolerance:
+        raise SystemExit(f'Sensor backends differ by more than {tolerance}px.')
+
+
+@cli.command('bake-sensors')
+@click.option('--angle-step', default=2.0, help='Width of the baked wedges of beam angles (degrees).')
+def bake_sensors(angle_step):
+    # Bake how far beams from every drivable pixel are clear into a table for the baked sensors
+    shape = bake_sensor_table(load_track_border(), PlayerCar.START_POS, angle_step=angle_step)
+    print(f'Baked clear beam distances for {shape[0]} pixels in {shape[1]} wedges.')
+
+
+@cli.command('compile-assets')
+def compile_assets_command():
+    # Bake the decoded images, distance fields and gate lines into one memory-mapped bundle
+    arrays = compile_assets()
+    size = sum(arr.nbytes for arr in arrays.values())
+    print(f'Compiled {len(arrays)} track assets ({size / 2**20:.1f} MB) into {ASSET_BUNDLE}.')
+
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
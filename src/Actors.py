@@ -0,0 +1,213 @@
+import queue
+import traceback
+import multiprocessing as mp
+import numpy as np
+
+from src.Environment import Environment
+from src.Policy import NumpyPolicy
+
+
+def actor_epsilon(actor_id, n_actors, base=0.4, alpha=7):
+    """
+    Lowest exploration rate of each actor, spread from base (actor 0) down to base**(1+alpha)
+    so that some actors keep exploring while others mostly follow the policy.
+    """
+    if n_actors == 1:
+        return base
+    return base ** (1 + alpha * actor_id / (n_actors - 1))
+
+
+class SharedWeights:
+    """
+    Copy of the q_eval weights in shared memory, published by the learner and read by the
+    actors. The version counter is bumped on every publish, so actors only copy the
+    weights when they have changed.
+    """
+    def __init__(self, ctx, weights):
+        self.shapes = [np.shape(w) for w in weights]
+        self.buffer = ctx.Array('f', sum(int(np.size(w)) for w in weights))
+        self.version = ctx.Value('i', 0)
+        self.publish(weights)
+
+    def publish(self, weights):
+        with self.buffer.get_lock():
+            flat = np.frombuffer(self.buffer.get_obj(), dtype=np.float32)
+            flat[:] = np.concatenate([np.ravel(w) for w in weights])
+            self.version.value += 1
+
+    def read(self):
+        """
+        Returns the list of weights and their version.
+        """
+        with self.buffer.get_lock():
+            flat = np.frombuffer(self.buffer.get_obj(), dtype=np.float32).copy()
+            version = self.version.value
+
+        weights = []
+        for shape in self.shapes:
+            size = int(np.prod(shape))
+            weights.append(flat[:size].reshape(shape))
+            flat = flat[size:]
+        return weights, version
+
+
+def run_actor(actor_id, epsilon_min, weights, transitions, stop, env_kwargs, seed,
+              epsilon_dec=0.00001, batch_size=256, sync_every=400, max_steps=3600):
+    """
+    Actor process - drives its own headless Environment with a NumPy copy of the policy
+    and sends the transitions (and finished episodes) to the learner in batches.
+    Its exploration rate decays from 1 to epsilon_min over its own steps, as the
+    exploration of DDQNAgent does.
+    """
+    np.random.seed(seed)
+    env = Environment(**env_kwargs)
+    policy_weights, version = weights.read()
+    policy = NumpyPolicy(policy_weights)
+    batch = TransitionBatch(actor_id)
+    total_steps = 0
+
+    while not stop.is_set():
+        state = env.reset()
+        score = 0
+        steps = 0
+        done = False
+
+        while not done and steps < max_steps:
+            epsilon = epsilon_min + (1 - epsilon_min) * np.exp(-epsilon_dec * total_steps)
+            if np.random.random() < epsilon:
+                action = np.random.randint(9)
+            else:
+                action = policy.choose_action(state)
+            new_state, reward, done = env.step(action)
+            batch.add(state, action, reward, new_state, done)
+            state = new_state
+            score += reward
+            steps += 1
+            total_steps += 1
+
+            if total_steps % sync_every == 0 and weights.version.value != version:
+                policy_weights, version = weights.read()
+                policy.set_weights(policy_weights)
+            if len(batch) >= batch_size:
+                if not send(transitions, batch, stop):
+                    return
+                batch = TransitionBatch(actor_id)
+
+        batch.episodes.append((score, env.gate_count, steps))
+
+
+def actor_process(actor_id, errors, *args):
+    """
+    Entry point of an actor process - runs run_actor, sending the traceback of anything
+    it raises to the learner through errors before the process exits.
+    """
+    try:
+        run_actor(actor_id, *args)
+    except BaseException:
+        errors.put((actor_id, traceback.format_exc()))
+        raise
+
+
+def send(transitions, batch, stop):
+    """
+    Put batch on the queue, waiting while it is full unless told to stop.
+    """
+    while not stop.is_set():
+        try:
+            transitions.put(batch.arrays(), timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class TransitionBatch:
+    """
+    Transitions collected by an actor, sent to the learner as arrays.
+    """
+    def __init__(self, actor_id):
+        self.actor_id = actor_id
+        self.rows = []
+        self.episodes = [] # (score, gates passed, steps) of each episode finished
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, state, action, reward, new_state, done):
+        self.rows.append((state, action, reward, new_state, done))
+
+    def arrays(self):
+        states, actions, rewards, new_states, dones = zip(*self.rows)
+        return {'actor_id': self.actor_id, 'episodes': self.episodes,
+                'states': np.array(states, dtype=np.float32), 'actions': np.array(actions, dtype=np.uint8),
+                'rewards': np.array(rewards, dtype=np.float32),
+                'new_states': np.array(new_states, dtype=np.float32), 'dones': np.array(dones)}
+
+
+class ActorPool:
+    """
+    N actor processes (see run_actor) streaming transitions to the learner, which owns
+    the replay memory, through a bounded queue. The learner publishes new q_eval weights
+    to the actors through shared memory.
+    """
+    def __init__(self, n_actors, weights, env_kwargs=None, seed=0, queue_batches=4):
+        # Spawn rather than fork, as the learner has TensorFlow (and its threads) running
+        ctx = mp.get_context('spawn')
+        self.weights = SharedWeights(ctx, weights)
+        self.transitions = ctx.Queue(maxsize=queue_batches * n_actors)
+        self.errors = ctx.Queue() # (actor_id, traceback) of actors that failed
+        self.stop = ctx.Event()
+        self.processes = [
+            ctx.Process(target=actor_process, daemon=True, name=f'actor-{i}',
+                        args=(i, self.errors, actor_epsilon(i, n_actors), self.weights, self.transitions,
+                              self.stop, env_kwargs or {}, seed + i))
+            for i in range(n_actors)]
+        for process in self.processes:
+            process.start()
+
+    def publish(self, weights):
+        self.weights.publish(weights)
+
+    def collect(self, block=False):
+        """
+        Return the batches the actors have sent so far (waiting for at least one if block).
+        Raises RuntimeError if an actor has died while there was nothing to collect.
+        """
+        batches = []
+        while block and not batches:
+            try:
+                batches.append(self.transitions.get(timeout=1))
+            except queue.Empty:
+                self.check()
+        try:
+            while True:
+                batches.append(self.transitions.get_nowait())
+        except queue.Empty:
+            pass
+        if not batches:
+            self.check()
+        return batches
+
+    def check(self):
+        """
+        Raise RuntimeError (with the actor's traceback, if it sent one) if any actor process
+        has exited while the pool is running, stopping the rest of the pool first.
+        """
+        dead = [process for process in self.processes if process.exitcode is not None]
+        if not dead or self.stop.is_set():
+            return
+        try:
+            actor_id, failure = self.errors.get(timeout=1)
+            message = f"Actor {actor_id} failed:\n{failure}"
+        except queue.Empty:
+            message = f"Actor process {dead[0].name} exited with code {dead[0].exitcode}"
+        self.close()
+        raise RuntimeError(message)
+
+    def close(self):
+        self.stop.set()
+        self.collect() # Let actors blocked on a full queue see the stop
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
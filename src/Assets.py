@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import hashlib
+import numpy as np
+import pygame
+
+from src.utils import scale_image, surface_to_grid, distance_transform
+from src.Checkpoint import atomic_write
+from src.RewardGates import RewardGate, GATE_MARGIN
+
+ASSET_BUNDLE = 'model/track_assets.bin'
+BUNDLE_VERSION = 2
+MAGIC = b'TRACKAST'
+ALIGNMENT = 64 # Byte alignment of each array in the bundle
+
+TRACK_SCALE = 0.9
+BACKGROUND_SCALE = 0.35
+BACKGROUND_IMG = "imgs/green-grass-background.jpg"
+TRACK_IMG = "imgs/track.png"
+TRACK_BORDER_IMG = "imgs/track-border.png"
+GATE_IMGS = [f"imgs/reward-gates/RewardGate{i}.png" for i in range(1, 14)]
+
+
+def source_digest():
+    """
+    Hash of everything the bundle is compiled from - the source images and the constants
+    used to process them - so a bundle can tell when it is out of date.
+    """
+    digest = hashlib.sha1(json.dumps([BUNDLE_VERSION, TRACK_SCALE, BACKGROUND_SCALE, GATE_MARGIN]).encode())
+    for fname in [BACKGROUND_IMG, TRACK_IMG, TRACK_BORDER_IMG, *GATE_IMGS]:
+        with open(fname, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def compile_assets(fname=ASSET_BUNDLE):
+    """
+    Decode, scale and preprocess the track images into a single binary bundle, for
+    TrackAssets to memory-map. Returns the arrays written (by name).
+    The file is a magic string, the version, the length of a JSON header describing
+    each array, the header itself, then the raw arrays at aligned offsets.
+    """
+    background = scale_image(pygame.image.load(BACKGROUND_IMG), BACKGROUND_SCALE)
+    track = scale_image(pygame.image.load(TRACK_IMG), TRACK_SCALE)
+    track_border = scale_image(pygame.image.load(TRACK_BORDER_IMG), TRACK_SCALE)
+    border_grid = surface_to_grid(track_border)
+    gates = RewardGate()
+
+    arrays = {
+        'background': image_array(background, 'RGB'),
+        'track': image_array(track, 'RGBA'),
+        'track_border': image_array(track_border, 'RGBA'),
+        'border_grid': border_grid,
+        'distance_field': distance_transform(border_grid),
+        'gate_centroids': np.array(gates.gate_centroids, dtype=np.int64),
+        'gate_segments': gates.gate_segments,
+    }
+    header = {'sources': source_digest(), 'arrays': {}}
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': arr.shape, 'offset': offset}
+        offset += -(-arr.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(header).encode()
+
+    def write(f):
+        f.write(MAGIC + np.array([BUNDLE_VERSION, len(header)], dtype='<u4').tobytes() + header)
+        for arr in arrays.values():
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            f.write(np.ascontiguousarray(arr).tobytes())
+
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    atomic_write(fname, write)
+    return arrays
+
+
+def image_array(surface, fmt):
+    """
+    Pixels of a surface as a (height, width, channels) uint8 array.
+    """
+    width, height = surface.get_size()
+    return np.frombuffer(pygame.image.tobytes(surface, fmt), dtype=np.uint8).reshape(height, width, len(fmt))
+
+
+class TrackAssets:
+    """
+    Read-only view of a bundle written by compile_assets. The file is memory-mapped and
+    every array is a view into the map, so opening it decodes nothing, and any number of
+    worker processes share one copy of it through the page cache.
+    """
+    def __init__(self, fname=ASSET_BUNDLE):
+        with open(fname, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        version, header_length = np.frombuffer(self.buffer, dtype='<u4', count=2, offset=len(MAGIC))
+        if self.buffer[:len(MAGIC)] != MAGIC or version != BUNDLE_VERSION:
+            raise ValueError(f"{fname} is not a version {BUNDLE_VERSION} asset bundle, "
+                             "recompile it with main.py compile-assets")
+        header_end = len(MAGIC) + 8 + int(header_length)
+        self.header = json.loads(self.buffer[len(MAGIC) + 8:header_end])
+        start = header_end + (-header_end % ALIGNMENT)
+
+        self.arrays = {}
+        for name, spec in self.header['arrays'].items():
+            dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+            self.arrays[name] = np.frombuffer(self.buffer, dtype=dtype, count=int(np.prod(shape)),
+                                              offset=start + spec['offset']).reshape(shape)
+
+        self.border_grid = self.arrays['border_grid']
+        self.distance_field = self.arrays['distance_field']
+        self.gate_centroids = [tuple(centroid) for centroid in self.arrays['gate_centroids'].tolist()]
+        self.gate_segments = self.arrays['gate_segments']
+
+    def surface(self, name):
+        """
+        One of the images ('background', 'track' or 'track_border') as a pygame surface.
+        """
+        pixels = self.arrays[name]
+        height, width, channels = pixels.shape
+        return pygame.image.frombytes(pixels.tobytes(), (width, height), 'RGBA' if channels == 4 else 'RGB')
+
+    def is_current(self):
+        return self.header['sources'] == source_digest()
+
+
+def load_assets(fname=ASSET_BUNDLE):
+    """
+    The compiled asset bundle, or None if it has not been compiled. Raises ValueError
+    if the images it was compiled from have changed since.
+    """
+    if not os.path.exists(fname):
+        return None
+    assets = TrackAssets(fname)
+    if not assets.is_current():
+        raise ValueError(f"{fname} is out of date with the images, recompile it with main.py compile-assets")
+    return assets
@@ -1,11 +1,34 @@
 import pygame
 import math
 
-from src.utils import rotate_center, scale_image
+from src.utils import scale_image
+
+ROTATION_STEP = 1 # Degrees between the cached rotations of the car image
+
+
+class RotationCache:
+    """
+    Rotated copies of an image and their masks, precomputed for every multiple of
+    step degrees, so that nothing needs rotating or masking while the game runs.
+    """
+    def __init__(self, img, step=ROTATION_STEP):
+        self.step = step
+        self.images = [pygame.transform.rotate(img, i * step) for i in range(round(360 / step))]
+        self.masks = [pygame.mask.from_surface(rot_img) for rot_img in self.images]
+
+    def index(self, angle):
+        """
+        Index of the cached rotation nearest to the given angle.
+        """
+        return round(angle / self.step) % len(self.images)
+
 
 class AbstractCar:
     def __init__(self, max_vel, rotation_vel):
-        self.img = self.IMG.convert_alpha() # Pickup img from child
+        # Pickup img from child. convert_alpha needs a display, so headless runs use the
+        # image as loaded (the alpha channel, and so the mask, is the same either way)
+        self.img = self.IMG.convert_alpha() if pygame.display.get_surface() else self.IMG
+        self.rotations = RotationCache(self.img)
         self.max_vel = max_vel
         self.rotation_vel = rotation_vel
         self.acceleration = 0.2
@@ -16,6 +39,7 @@ class AbstractCar:
     def reset(self):
         self.angle = 0
         self.x, self.y = self.START_POS # Define center of car
+        self.prev_x, self.prev_y = self.START_POS # Center of car before the last move
         self.update_car_img() # Update rotated image based on new position
         self.vel = 0
         self.driftMomentum = 0
@@ -31,21 +55,23 @@ class AbstractCar:
         elif right:
             self.angle -= self.rotation_vel * multiplier
 
-        # round self.angle to one decimal place
-        # store all the rotated images ahead of time
-        
     def update_car_img(self):
         """
-        Calculate the new image/position of car based on current rotation
+        Calculate the new image/position of car based on current rotation.
+        The image and mask are taken from the cache, at the nearest cached angle.
         """
-        self.rot_img, (self.rot_x, self.rot_y) = rotate_center(
-                    self.img, (self.x, self.y), self.angle)
+        i = self.rotations.index(self.angle)
+        self.rot_img = self.rotations.images[i]
+        self.rot_mask = self.rotations.masks[i]
+        # Keep the rotated image centered on the car (as in utils.rotate_center)
+        new_rect = self.rot_img.get_rect(center=self.img.get_rect(center=(self.x, self.y)).center)
+        self.rot_x, self.rot_y = new_rect.topleft
 
     def draw(self, win):
         """
-        Draw the car on screen
+        Draw the car on screen, returning the rect drawn over
         """
-        win.blit(self.rot_img, (self.rot_x, self.rot_y))
+        return win.blit(self.rot_img, (self.rot_x, self.rot_y))
 
     def move_forward(self, turn_left, turn_right):
         """
@@ -80,6 +106,7 @@ class AbstractCar:
         drift_x = self.driftMomentum * math.sin(drift_radians)
         drift_y = self.driftMomentum * math.cos(drift_radians)
 
+        self.prev_x, self.prev_y = self.x, self.y
         self.x -= (vel_x + drift_x)
         self.y -= (vel_y + drift_y)
 
@@ -102,11 +129,8 @@ class AbstractCar:
         Detect if collision has occured between provided mask and the car object.
         """
         # x, y parameters are pos of input mask
-        car_mask = pygame.mask.from_surface(self.rot_img)
         offset = (int(self.rot_x-x), int(self.rot_y-y))
-        poi = mask.overlap(car_mask, offset)
-        car_mask = None # Deallocate for memory
-        return poi
+        return mask.overlap(self.rot_mask, offset)
     
     def bounce(self):
         """
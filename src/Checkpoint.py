@@ -0,0 +1,191 @@
+import os
+import json
+import atexit
+import queue
+import threading
+import numpy as np
+
+
+def atomic_write(path, write):
+    """
+    Call write(file) on a temporary file, then rename it over path, so path always
+    holds either the old or the new contents in full (even after a crash).
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpointer:
+    """
+    Incremental, asynchronous checkpoints of a PrioritisedMemory. Each save gathers the
+    replay rows and sum tree nodes changed since the previous save (a consistent
+    snapshot, taken on the calling thread) and hands them to a background thread, which
+    appends them to the checkpoint directory as a delta segment. Every compact_every
+    segments they are merged back into a single base segment.
+
+    Segments are written to a temporary file and renamed, and the manifest listing them
+    (along with the training counters) is only replaced once they are complete, so a
+    crash mid-save leaves the previous checkpoint intact.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory, compact_every=8):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.manifest = self.read_manifest()
+        self.tracking = None # Memory whose changes are being tracked
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self.write_loop, name='checkpoint-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.wait) # Let the last checkpoint finish before exiting
+
+    def exists(self):
+        return self.manifest is not None
+
+    def read_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, memory, meta):
+        """
+        Snapshot the changes to memory and queue them to be written, along with the
+        dict of counters meta. Returns as soon as the snapshot has been taken.
+        """
+        self.raise_error()
+        if self.tracking is not memory or self.manifest is None:
+            # Nothing on disk to build on - save everything
+            rows = np.arange(memory.mem_size)
+            leaves = rows + memory.sumTree.indexOfFirstData
+            memory.track_changes()
+            self.tracking = memory
+            full = True
+        else:
+            rows, leaves = memory.take_changes()
+            full = False
+
+        tree = memory.sumTree
+        tree.sync_min_tree()
+        nodes = np.arange(tree.size) if full else ancestors(leaves)
+        segment = {'rows': rows, 'nodes': nodes, 'tree': tree.tree[nodes],
+                   'treeMin': tree.minTree[nodes]}
+        for name, arr in memory.row_arrays().items():
+            segment[name] = arr[rows]
+
+        if self.manifest is None:
+            self.manifest = {'segments': [], 'next': 0}
+        self.queue.put((segment, dict(meta), full))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write_segment(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write_segment(self, segment, meta, full):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = dict(self.manifest)
+        name = f"segment_{manifest['next']:06d}.npz"
+        atomic_write(os.path.join(self.directory, name), lambda f: np.savez(f, **segment))
+
+        replaced = manifest['segments'] if full else []
+        manifest['segments'] = [name] if full else manifest['segments'] + [name]
+        manifest['next'] += 1
+        manifest['meta'] = meta
+        self.write_manifest(manifest)
+
+        if len(manifest['segments']) > self.compact_every:
+            replaced = manifest['segments']
+            merged = self.merge(replaced)
+            name = f"segment_{manifest['next']:06d}.npz"
+            atomic_write(os.path.join(self.directory, name), lambda f: np.savez(f, **merged))
+            manifest = dict(manifest, segments=[name], next=manifest['next'] + 1)
+            self.write_manifest(manifest)
+
+        for old in replaced:
+            os.remove(os.path.join(self.directory, old))
+
+    def write_manifest(self, manifest):
+        path = os.path.join(self.directory, self.MANIFEST)
+        atomic_write(path, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+        self.manifest = manifest
+
+    def merge(self, names):
+        """
+        Apply the named segments in order, giving a single (full) segment.
+        """
+        merged = {}
+        for name in names:
+            with np.load(os.path.join(self.directory, name)) as segment:
+                if not merged:
+                    merged = {key: segment[key] for key in segment.files}
+                    continue
+                rows, nodes = segment['rows'], segment['nodes']
+                for key in segment.files:
+                    if key in ('rows', 'nodes'):
+                        continue
+                    index = nodes if key in ('tree', 'treeMin') else rows
+                    merged[key][index] = segment[key]
+        return merged
+
+    def load(self, memory):
+        """
+        Restore memory from the checkpoint and return the saved counters. Changes made
+        from here on are tracked, so the next save only writes what differs.
+        """
+        merged = self.merge(self.manifest['segments'])
+        tree = memory.sumTree
+        tree.tree[merged['nodes']] = merged['tree']
+        tree.minTree[merged['nodes']] = merged['treeMin']
+        for name, arr in memory.row_arrays().items():
+            arr[merged['rows']] = merged[name]
+
+        meta = self.manifest['meta']
+        memory.mem_count = meta['mem_count']
+        tree.dataPointer = meta['tree_pointer']
+        memory.track_changes()
+        self.tracking = memory
+        return meta
+
+    def wait(self):
+        """
+        Block until every queued checkpoint has been written.
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.writer.join()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing checkpoint failed") from error
+
+
+def ancestors(leaves):
+    """
+    The given tree nodes along with all of their ancestors (sorted, without repeats).
+    """
+    nodes = np.unique(leaves)
+    found = [nodes]
+    while len(nodes) > 0:
+        nodes = np.unique((nodes[nodes > 0] - 1) // 2)
+        found.append(nodes)
+    return np.unique(np.concatenate(found))
@@ -0,0 +1,208 @@
+import pygame
+
+from src.utils import scale_image
+from src.Cars import PlayerCar
+from src.GameInfo import TickGameInfo
+from src.Sensor import Sensor, DistanceFieldSensor, BakedSensor
+from src.RewardGates import RewardGate
+from src.Profiling import PROFILER
+from src.Assets import load_assets
+
+
+def load_track_border():
+    """
+    Load the track border image at game scale. Does not require a display.
+    """
+    return scale_image(pygame.image.load("imgs/track-border.png"), 0.9)
+
+
+class Environment:
+    """
+    Simulation core of the game - car physics, beam sensors, reward gates and collisions.
+    Nothing is drawn and no display or event pump is needed, so this can be stepped
+    as fast as the CPU allows (e.g. when training on a server with no screen).
+    """
+    def __init__(self, track_border=None, debug_surface=None, game_info=None, sensors='mask',
+                 assets=None):
+        """
+        track_border = track border surface (loaded from disk if not provided)
+        debug_surface = surface to draw sensor beams onto (None for no drawing)
+        game_info = GameInfo used to track score/time (simulated tick clock if not provided)
+        sensors = beam sensor backend - 'mask' (Sensor), 'distance_field' (DistanceFieldSensor)
+                  or 'baked' (BakedSensor, needs the table from main.py bake-sensors)
+        assets = compiled TrackAssets (main.py compile-assets) to take the track border, its
+                 distance field and the gate lines from rather than computing them. Loaded
+                 by default if track_border is not provided and the bundle has been compiled.
+        """
+        if track_border is None:
+            if assets is None:
+                assets = load_assets()
+            track_border = assets.surface('track_border') if assets is not None else load_track_border()
+        fields = {} if assets is None else dict(border_grid=assets.border_grid,
+                                                distance_field=assets.distance_field)
+        self.track_border_mask = pygame.mask.from_surface(track_border)
+
+        self.MANUAL_CONTROL = False
+        self.player_car = PlayerCar(8, 5)
+        self.game_info = game_info if game_info is not None else TickGameInfo()
+        if sensors == 'distance_field':
+            self.beam_sensors = DistanceFieldSensor(track_border, **fields)
+        elif sensors == 'baked':
+            self.beam_sensors = BakedSensor(track_border, **fields)
+        elif debug_surface is None:
+            self.beam_sensors = Sensor(track_border, track_border, debug=False)
+        else:
+            self.beam_sensors = Sensor(debug_surface, track_border)
+        self.reward_gates = RewardGate(assets)
+        self.reward = 0
+        self.gate_count = 0
+
+    def reset(self):
+        """
+        Reset the game and return the initial model input.
+        """
+        self.game_reset()
+        state, _, _ = self.game_state()
+        return state
+
+    def step(self, action):
+        """
+        Iterate the game by one tick using an action index from the agent (0-8).
+        Returns the model input, reward and whether the episode is done.
+        """
+        self.game_loop(action + 1)
+        return self.game_state()
+
+    def snapshot(self):
+        """
+        Everything about the game that changes as it is stepped, to put it back to this
+        point later with restore.
+        """
+        car = self.player_car
+        return dict(x=car.x, y=car.y, angle=car.angle, vel=car.vel, drift=car.driftMomentum,
+                    prev_x=car.prev_x, prev_y=car.prev_y, bounce_flag=car.bounce_flag, dead=car.dead,
+                    active_gate=self.reward_gates.active_gate, gate_count=self.gate_count,
+                    score=self.game_info.score, ticks=self.game_info.ticks)
+
+    def restore(self, snapshot):
+        """
+        Put the game back to a snapshot (or a record of a step of a Trajectory, taken
+        before the step).
+        """
+        car = self.player_car
+        car.x, car.y, car.angle = float(snapshot['x']), float(snapshot['y']), float(snapshot['angle'])
+        car.vel, car.driftMomentum = float(snapshot['vel']), float(snapshot['drift'])
+        car.prev_x, car.prev_y = float(snapshot['prev_x']), float(snapshot['prev_y'])
+        car.bounce_flag, car.dead = int(snapshot['bounce_flag']), bool(snapshot['dead'])
+        car.update_car_img()
+        self.reward_gates.active_gate = int(snapshot['active_gate'])
+        self.gate_count = int(snapshot['gate_count'])
+        self.game_info.score, self.game_info.ticks = int(snapshot['score']), int(snapshot['ticks'])
+
+    def handle_collision(self):
+        """
+        Check for collision between car and track border
+        """
+        bounce_flag = 0
+
+        if self.MANUAL_CONTROL:
+            if self.player_car.collide(self.track_border_mask) != None:
+                self.player_car.bounce()
+                # Add a delay after bounce (where no input allowed)
+                bounce_flag = 6
+        else:
+            if self.player_car.collide(self.track_border_mask) != None:
+                self.player_car.dead = True
+
+        return bounce_flag
+
+    def game_reset(self):
+        """
+        Reset all elements of the game
+        """
+        self.player_car.reset()
+        self.player_car.dead = False
+        self.game_info.reset()
+        self.reward_gates.reset()
+        self.gate_count = 0
+
+    def game_loop(self, action_no):
+        """
+        Given a set action number, iterate the game state by one tick.
+        """
+        self.reward = -1
+        self.game_info.tick()
+
+        if self.player_car.bounce_flag > 0:
+            # Overwrite player input to "Do Nothing"
+            self.player_car.bounce_flag -= 1
+            action_no = 9
+
+        with PROFILER.phase('env.physics'):
+            self.player_car.take_action(action_no)
+
+        if abs(self.player_car.vel) < 0.1: # Incentivize speed!
+            self.reward = -5
+        elif abs(self.player_car.vel) < 1:
+            self.reward = -3
+        with PROFILER.phase('env.reward_gates'):
+            passed = self.reward_gates.passed_gate(self.player_car, self.game_info)
+        if passed:
+            # print(f"Reward gate passed!- {self.reward_gates.active_gate}")
+            self.reward = 25
+            self.gate_count += 1
+
+        if self.player_car.bounce_flag == 0:
+            with PROFILER.phase('env.collision'):
+                self.player_car.bounce_flag = self.handle_collision()
+
+        # Updating the car img is done after detecting collision etc as model was trained (erroneously)
+        # with it this way around. For correct behaviour, the update_car_img should really be in the
+        # player_car.rotate function call
+        with PROFILER.phase('env.car_img'):
+            self.player_car.update_car_img()
+
+        return
+
+    def game_state(self):
+        with PROFILER.phase('env.sensors'):
+            distances = self.beam_sensors.beam_distances(self.player_car)
+
+        with PROFILER.phase('env.gate_inputs'):
+            gate_dist = self.reward_gates.distance_to_gate(self.player_car.x, self.player_car.y)
+            gate_angle = self.reward_gate_angle()
+
+        model_input = distances
+        model_input.append(self.player_car.vel)
+        model_input.append(self.player_car.driftMomentum)
+        model_input.append(gate_dist)
+        model_input.append(gate_angle)
+
+        reward, done = self.outcome()
+        return model_input, reward, done
+
+    def outcome(self):
+        """
+        Reward and done flag of the last tick, as game_state returns them (for when the model
+        input is not needed).
+        """
+        done = self.game_finished()
+        if done:
+            self.reward = -100
+        return self.reward, done
+
+    def game_finished(self):
+        return self.player_car.dead
+
+    def reward_gate_angle(self):
+        """
+        Calculate the angle from forward of car to centroid of next reward gate.
+        """
+        angle = self.reward_gates.angle_to_gate(self.player_car.x, self.player_car.y)
+        angle = angle - self.player_car.angle
+        angle = angle % 360
+        if angle > 180:
+            angle -= 360
+        elif angle < -179:
+            angle += 360
+        return angle
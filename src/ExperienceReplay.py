@@ -1,5 +1,6 @@
 import numpy as np
 from src.SumTree import SumTree
+from src.ReplayStorage import MemmapStorage
 
 class PrioritisedMemory:
     # some cheeky hyperparameters
@@ -9,8 +10,18 @@ class PrioritisedMemory:
     bIncreaseRate = 0.001
     errorsClippedAt = 1.0 # Highest priority possible
 
-    def __init__(self, capacity, input_shape, n_actions, discrete=False):
-        self.sumTree = SumTree(capacity)
+    def __init__(self, capacity, input_shape, n_actions, discrete=False, compact=False,
+                 state_dtype=np.float32, storage_dir=None):
+        """
+        compact = store each state only once (the next state of a transition is read from
+                  the following slot), as state_dtype (e.g. np.float16 to quantize further),
+                  and store actions as uint8 indices rather than one-hot rows
+        storage_dir = keep the memory (and sum tree) in memory-mapped files in this directory
+                      rather than in RAM. An existing memory there is reopened as it was
+                      last saved
+        """
+        self.storage = MemmapStorage(storage_dir) if storage_dir is not None else None
+        self.sumTree = SumTree(capacity, self._allocate)
 
         self.eps = 0.01 # Epsilon - minimum priority possible
         self.a = 0.06 # Alpha - how much prioritization is used - a = 0 is uniform
@@ -20,24 +31,47 @@ class PrioritisedMemory:
         self.discrete = discrete
         self.max_priority = self.eps
         self.mem_size = capacity
+        self.compact = compact
 
-        self.state_memory = np.zeros((self.mem_size, input_shape))
-        self.new_state_memory = np.zeros((self.mem_size, input_shape))
-        self.action_memory = np.zeros((self.mem_size, n_actions), dtype=np.int8)
-        self.reward_memory = np.zeros(self.mem_size)
-        self.terminal_memory = np.zeros(self.mem_size, dtype=np.int8)
+        if compact:
+            self.state_memory = self._allocate('state', (self.mem_size, input_shape), state_dtype)
+            self.new_state_memory = None
+            self.action_memory = self._allocate('action', self.mem_size, np.uint8)
+            self.reward_memory = self._allocate('reward', self.mem_size, np.float32)
+        else:
+            self.state_memory = self._allocate('state', (self.mem_size, input_shape), np.float64)
+            self.new_state_memory = self._allocate('new_state', (self.mem_size, input_shape), np.float64)
+            self.action_memory = self._allocate('action', (self.mem_size, n_actions), np.int8)
+            self.reward_memory = self._allocate('reward', self.mem_size, np.float64)
+        self.terminal_memory = self._allocate('terminal', self.mem_size, np.int8)
 
         self.mem_count = 0 # Current memory count
         self.real_size = 0 # No of entries actually in buffer
+        self.changedRows = None # Rows/leaves written since take_changes (None when not tracked)
+        self.changedLeaves = None
+        if self.storage is not None and self.storage.header:
+            self.load_header()
+
+    def _allocate(self, name, shape, dtype):
+        """
+        Zeroed array for the memory, held in RAM or in the memory-mapped storage.
+        """
+        if self.storage is None:
+            return np.zeros(shape, dtype=dtype)
+        return self.storage.array(name, shape, dtype)
 
     def store_transition(self, state, action, reward, state_, done):
         """ when an experience is first added to memory it has the highest priority
             so each experience is run through at least once
         """
+        if self.compact:
+            self.store_compact_transition(state, action, reward, state_, done)
+            return
+
         index = self.mem_count % self.mem_size # Current posn in memory
 
         # store experience index with maximum priority in sum tree
-        self.sumTree.add(self.max_priority, index)
+        self.sumTree.add(self.max_priority)
 
         self.state_memory[index] = state
         self.new_state_memory[index] = state_
@@ -50,17 +84,45 @@ class PrioritisedMemory:
             self.action_memory[index] = action
         self.reward_memory[index] = reward
         self.terminal_memory[index] = 1 - int(done)
+        if self.changedRows is not None:
+            self.changedRows.append(index)
 
         self.mem_count += 1
         self.read_size = min(self.mem_size, self.real_size + 1) # Needed?
         return
 
+    def store_compact_transition(self, state, action, reward, state_, done):
+        """
+        Store a transition in compact mode. The next state of the newest transition is
+        written ahead into the following slot (retiring the oldest transition there).
+        If the new transition does not carry on from that state (e.g. a new episode has
+        started), the slot is skipped and left excluded from sampling.
+        """
+        index = self.sumTree.dataPointer
+        state = np.asarray(state, dtype=self.state_memory.dtype)
+        if self.mem_count > 0 and not np.array_equal(state, self.state_memory[index]):
+            self.sumTree.skip()
+            index = self.sumTree.dataPointer
+
+        # store experience index with maximum priority in sum tree
+        self.sumTree.add(self.max_priority)
+
+        self.state_memory[index] = state
+        self.action_memory[index] = action
+        self.reward_memory[index] = reward
+        self.terminal_memory[index] = 1 - int(done)
+
+        following = self.sumTree.dataPointer
+        self.state_memory[following] = state_
+        self.sumTree.exclude(following + self.sumTree.indexOfFirstData)
+        if self.changedRows is not None:
+            self.changedRows.extend((index, following))
+
+        self.mem_count += 1
+        return
 
-    def sample_buffer(self, batch_size):
-        batchIndexes = []
-        sampleIndexes = []
-        batchISWeights = np.zeros([batch_size], dtype=np.float32)
 
+    def sample_buffer(self, batch_size):
         # so we divide the priority space up into n different priority segments
         totalPriority = self.sumTree.total_priority()
         prioritySegmentSize = totalPriority / batch_size
@@ -73,35 +135,29 @@ class PrioritisedMemory:
         # we are going to need to get the maximum weight and divide all weights by that
 
         # the largest weight will have the lowest priority and thus the lowest probability of being chosen
-        #minPriority = np.min(np.maximum(self.sumTree.tree[self.sumTree.indexOfFirstData:], self.eps))
-        minPriority = np.min(self.sumTree.tree[self.sumTree.indexOfFirstData:])
+        # (tracked by the min tree, so no need to scan every leaf)
+        minPriority = self.sumTree.min_priority()
         minPriority = max(minPriority, self.eps) # Cannot go lower than epsilon
         
         minProbability = minPriority / totalPriority
         maxWeight = (minProbability * batch_size) ** (-self.b)
 
-        for i in range(batch_size):
-            # get the upper and lower bounds of the segment
-            segmentMin = prioritySegmentSize * i
-            segmentMax = segmentMin + prioritySegmentSize # e.g. segment*(i+1)
-
-            value = np.random.uniform(segmentMin, segmentMax)
+        # draw one value uniformly from within each segment
+        segmentMins = prioritySegmentSize * np.arange(batch_size)
+        values = np.random.uniform(segmentMins, segmentMins + prioritySegmentSize)
 
-            treeIndex, priority, sampleIndex = self.sumTree.getLeaf(value)
+        # descend the tree for the whole batch at once
+        batchIndexes, priorities, sampleIndexes = self.sumTree.get_leaves(values)
 
-            #batchIndexes[i] = treeIndex
-            batchIndexes.append(treeIndex)
-            #sampleIndexes[i] = sampleIndex
-            sampleIndexes.append(sampleIndex)
-
-            samplingProbability = priority / totalPriority
-
-            #  IS = (1/N * 1/P(i))**b /max wi == (N*P(i))**-b  /max wi
-
-            batchISWeights[i] = np.power(batch_size * samplingProbability, -self.b) / maxWeight
+        #  IS = (1/N * 1/P(i))**b /max wi == (N*P(i))**-b  /max wi
+        samplingProbabilities = priorities / totalPriority
+        batchISWeights = (np.power(batch_size * samplingProbabilities, -self.b) / maxWeight).astype(np.float32)
 
         states = self.state_memory[sampleIndexes]
-        new_states = self.new_state_memory[sampleIndexes]
+        if self.compact:
+            new_states = self.state_memory[(sampleIndexes + 1) % self.mem_size]
+        else:
+            new_states = self.new_state_memory[sampleIndexes]
         actions = self.action_memory[sampleIndexes]
         rewards = self.reward_memory[sampleIndexes]
         terminal = self.terminal_memory[sampleIndexes]
@@ -119,19 +175,53 @@ class PrioritisedMemory:
         clippedErrors = np.minimum(absoluteErrors + self.eps, self.errorsClippedAt)
         priorities = np.power(clippedErrors, self.a)
 
-        for treeIndex, priority in zip(treeIndexes, priorities):
-            self.sumTree.update(treeIndex, priority)
+        self.sumTree.update_many(treeIndexes, priorities)
+        self.max_priority = max(self.max_priority, np.max(priorities))
+        if self.changedLeaves is not None:
+            self.changedLeaves.append(np.asarray(treeIndexes, dtype=np.int64))
 
-            self.max_priority = max(self.max_priority, priority)
-            
         return
 
+    def row_arrays(self):
+        """
+        The arrays holding one row per transition, by name.
+        """
+        arrays = {'state': self.state_memory, 'new_state': self.new_state_memory,
+                  'action': self.action_memory, 'reward': self.reward_memory,
+                  'terminal': self.terminal_memory}
+        return {name: arr for name, arr in arrays.items() if arr is not None}
+
+    def track_changes(self):
+        """
+        Start (or restart) recording which rows and sum tree leaves are written.
+        """
+        self.changedRows = []
+        self.changedLeaves = []
+
+    def take_changes(self):
+        """
+        Return the rows and the sum tree leaves written since the last call (or since
+        track_changes), and start recording afresh.
+        """
+        rows = np.unique(np.array(self.changedRows, dtype=np.int64))
+        leaves = np.concatenate([rows + self.sumTree.indexOfFirstData] + self.changedLeaves)
+        self.track_changes()
+        return rows, leaves
+
     def save_buffer(self, filename):
         """
-        Save contents of the memory buffer to external files.
+        Save contents of the memory buffer to external files. With memory-mapped storage
+        the arrays are already on disk, so they are just flushed (filename is not used).
         """
+        if self.storage is not None:
+            self.sumTree.sync_min_tree()
+            self.storage.flush(capacity=self.mem_size, compact=self.compact,
+                               mem_count=int(self.mem_count), tree_pointer=int(self.sumTree.dataPointer))
+            return self.sumTree.dataPointer
+
         np.save(filename + '_state', self.state_memory)
-        np.save(filename + '_new_state', self.new_state_memory)
+        if not self.compact:
+            np.save(filename + '_new_state', self.new_state_memory)
         np.save(filename + '_action', self.action_memory)
         np.save(filename + '_reward', self.reward_memory)
         np.save(filename + '_terminal', self.terminal_memory)
@@ -141,39 +231,77 @@ class PrioritisedMemory:
 
     def load_buffer(self, filename, treePointer):
         """
-        Load contents of the memory buffer from external files.
+        Load contents of the memory buffer from external files. Memory-mapped storage is
+        opened in place (and its counters restored from its header, if it has been saved)
+        when the memory is created, so nothing is read here.
         """
+        if self.storage is not None:
+            return
+
         self.state_memory = np.load(filename + '_state.npy')
-        self.new_state_memory = np.load(filename + '_new_state.npy')
+        if not self.compact:
+            self.new_state_memory = np.load(filename + '_new_state.npy')
         self.action_memory = np.load(filename + '_action.npy')
         self.reward_memory = np.load(filename + '_reward.npy')
         self.terminal_memory = np.load(filename + '_terminal.npy')
         self.sumTree.load_tree(filename, treePointer)
         return
 
+    def load_header(self):
+        """
+        Restore the counters of a memory-mapped memory from its header.
+        """
+        header = self.storage.header
+        if header['capacity'] != self.mem_size or header['compact'] != self.compact:
+            raise ValueError(f"Replay storage in {self.storage.directory} was saved with capacity "
+                             f"{header['capacity']} and compact={header['compact']}")
+        self.mem_count = header['mem_count']
+        self.sumTree.dataPointer = header['tree_pointer']
+        return
+
 
 class ExperienceBuffer:
     """
     This class will be used to store the past experiences of the environment (up to max_size)
     for the training of the DDQN model.
     """
-    def __init__(self, max_size, input_shape, n_actions, discrete=False):
+    def __init__(self, max_size, input_shape, n_actions, discrete=False, compact=False,
+                 state_dtype=np.float32):
+        """
+        compact = store each state only once (see PrioritisedMemory), as state_dtype, with
+                  actions as uint8 indices (requires discrete actions)
+        """
         self.mem_size = max_size
         self.mem_count = 0
         self.discrete = discrete
+        self.compact = compact
 
         # Memory Buffers - could also use deque instead of numpy arrays
-        self.state_memory = np.zeros((self.mem_size, input_shape))
-        self.new_state_memory = np.zeros((self.mem_size, input_shape))
-        dtype = np.int8 if self.discrete else np.float32
-        self.action_memory = np.zeros((self.mem_size, n_actions), dtype=dtype)
-        self.reward_memory = np.zeros(self.mem_size)
+        if compact:
+            self.state_memory = np.zeros((self.mem_size, input_shape), dtype=state_dtype)
+            self.new_state_memory = None
+            self.action_memory = np.zeros(self.mem_size, dtype=np.uint8)
+            self.reward_memory = np.zeros(self.mem_size, dtype=np.float32)
+            # Slots holding a transition (rather than just the next state of one)
+            self.valid_memory = np.zeros(self.mem_size, dtype=bool)
+            self.pointer = 0
+            self.slot_count = 0
+        else:
+            self.state_memory = np.zeros((self.mem_size, input_shape))
+            self.new_state_memory = np.zeros((self.mem_size, input_shape))
+            dtype = np.int8 if self.discrete else np.float32
+            self.action_memory = np.zeros((self.mem_size, n_actions), dtype=dtype)
+            self.reward_memory = np.zeros(self.mem_size)
         self.terminal_memory = np.zeros(self.mem_size, dtype=np.int8)
 
     def store_transition(self, state, action, reward, state_, done):
         """
         Store the latest experience of the model (for later use)
         """
+        if self.compact:
+            self.store_compact_transition(state, action, reward, state_, done)
+            return
+
         index = self.mem_count % self.mem_size
         self.state_memory[index] = state
         self.new_state_memory[index] = state_
@@ -188,11 +316,38 @@ class ExperienceBuffer:
         self.terminal_memory[index] = 1 - int(done)
         self.mem_count += 1
 
+    def store_compact_transition(self, state, action, reward, state_, done):
+        """
+        Compact mode version of store_transition - the next state is written ahead into
+        the following slot, which is skipped if the next transition does not carry on
+        from it (e.g. a new episode has started).
+        """
+        state = np.asarray(state, dtype=self.state_memory.dtype)
+        if self.mem_count > 0 and not np.array_equal(state, self.state_memory[self.pointer]):
+            self.pointer = (self.pointer + 1) % self.mem_size
+            self.slot_count += 1
+
+        index = self.pointer
+        self.state_memory[index] = state
+        self.action_memory[index] = action
+        self.reward_memory[index] = reward
+        self.terminal_memory[index] = 1 - int(done)
+        self.valid_memory[index] = True
+
+        self.pointer = (index + 1) % self.mem_size
+        self.state_memory[self.pointer] = state_
+        self.valid_memory[self.pointer] = False
+        self.slot_count += 1
+        self.mem_count += 1
+
     def sample_buffer(self, batch_size):
         """
         Return a random sample of `batch_size` previous experiences for
         training.
         """
+        if self.compact:
+            return self.sample_compact_buffer(batch_size)
+
         max_mem = min(self.mem_count, self.mem_size) # Avoid sampling empty entries
         batch = np.random.choice(max_mem, batch_size)
         states = self.state_memory[batch]
@@ -202,13 +357,37 @@ class ExperienceBuffer:
         terminal = self.terminal_memory[batch]
 
         return states, actions, rewards, new_states, terminal
+
+    def sample_compact_buffer(self, batch_size):
+        """
+        Compact mode version of sample_buffer, redrawing any slot that does not hold a
+        transition.
+        """
+        max_mem = min(self.slot_count, self.mem_size)
+        batch = np.random.choice(max_mem, batch_size)
+        invalid = ~self.valid_memory[batch]
+        while invalid.any():
+            batch[invalid] = np.random.choice(max_mem, np.count_nonzero(invalid))
+            invalid = ~self.valid_memory[batch]
+
+        states = self.state_memory[batch]
+        new_states = self.state_memory[(batch + 1) % self.mem_size]
+        actions = self.action_memory[batch]
+        rewards = self.reward_memory[batch]
+        terminal = self.terminal_memory[batch]
+
+        return states, actions, rewards, new_states, terminal
     
     def save_buffer(self,filename):
         """
         Save contents of the memory buffer to external files.
         """
         np.save(filename + '_state', self.state_memory)
-        np.save(filename + '_new_state', self.new_state_memory)
+        if self.compact:
+            np.save(filename + '_valid', self.valid_memory)
+            np.save(filename + '_pointer', np.array([self.pointer, self.slot_count]))
+        else:
+            np.save(filename + '_new_state', self.new_state_memory)
         np.save(filename + '_action', self.action_memory)
         np.save(filename + '_reward', self.reward_memory)
         np.save(filename + '_terminal', self.terminal_memory)
@@ -218,7 +397,11 @@ class ExperienceBuffer:
         Load contents of the memory buffer from external files.
         """
         self.state_memory = np.load(filename + '_state.npy')
-        self.new_state_memory = np.load(filename + '_new_state.npy')
+        if self.compact:
+            self.valid_memory = np.load(filename + '_valid.npy')
+            self.pointer, self.slot_count = np.load(filename + '_pointer.npy')
+        else:
+            self.new_state_memory = np.load(filename + '_new_state.npy')
         self.action_memory = np.load(filename + '_action.npy')
         self.reward_memory = np.load(filename + '_reward.npy')
-        self.terminal_memory = np.load(filename + '_terminal.npy')
\ No newline at end of file
+        self.terminal_memory = np.load(filename + '_terminal.npy')
@@ -1,87 +1,76 @@
 import pygame
 
 from src.utils import scale_image
-from src.Cars import PlayerCar
 from src.GameInfo import GameInfo
-from src.Sensor import Sensor
-from src.RewardGates import RewardGate
+from src.Environment import Environment
+from src.Assets import load_assets
+from src.Renderer import Renderer
 
 pygame.font.init()
 
 MAIN_FONT = pygame.font.SysFont("comicsans", 40)
 
-BACKGROUND = scale_image(pygame.image.load("imgs/green-grass-background.jpg"), 0.35)
-TRACK = scale_image(pygame.image.load("imgs/track.png"), 0.9)
+ASSETS = load_assets() # Compiled images (main.py compile-assets), or None to decode them here
+if ASSETS is not None:
+    BACKGROUND = ASSETS.surface('background')
+    TRACK = ASSETS.surface('track')
+else:
+    BACKGROUND = scale_image(pygame.image.load("imgs/green-grass-background.jpg"), 0.35)
+    TRACK = scale_image(pygame.image.load("imgs/track.png"), 0.9)
 
 WIDTH, HEIGHT = TRACK.get_width(), TRACK.get_height()
 WIN = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("Car Driving")
 
-TRACK_BORDER = scale_image(pygame.image.load("imgs/track-border.png").convert_alpha(), 0.9)
+if ASSETS is not None:
+    TRACK_BORDER = ASSETS.surface('track_border').convert_alpha()
+else:
+    TRACK_BORDER = scale_image(pygame.image.load("imgs/track-border.png").convert_alpha(), 0.9)
 TRACK_BORDER_MASK = pygame.mask.from_surface(TRACK_BORDER)
 
 
-class Game:
-    def __init__(self):
-        self.MANUAL_CONTROL = False
-        self.player_car = PlayerCar(8, 5)
-        self.game_info = GameInfo()
-        self.beam_sensors = Sensor(WIN, TRACK_BORDER)
-        self.reward_gates = RewardGate()
-        self.reward = 0
-        self.gate_count = 0 # 
+class Game(Environment):
+    """
+    Environment shown in a pygame window, with manual (keyboard) control available.
+    """
+    def __init__(self, show_beams=False):
+        """
+        show_beams = draw the sensor beams (and where they hit the border) every frame, for debugging
+        """
+        super().__init__(TRACK_BORDER, debug_surface=WIN if show_beams else None, game_info=GameInfo(),
+                         assets=ASSETS)
+        self.show_beams = show_beams
 
         self.clock = pygame.time.Clock()
         self.images = [(BACKGROUND, (0,0)), (TRACK, (0,0))]
+        self.renderer = Renderer(WIN, self.images, MAIN_FONT)
 
     def draw(self):
         """
-        Draw the background, text and player car to the screen
+        Draw the text and player car (and sensor beams, if shown) to the screen (over the background).
+        Only what has changed since the last frame is redrawn - returns the rects of the
+        screen that changed, to pass to pygame.display.update.
         """
+        renderer = self.renderer
+        renderer.begin()
 
-        for img, pos in self.images:
-            WIN.blit(img, pos)
+        if self.show_beams:
+            renderer.mark(self.beam_sensors.draw_beams())
 
-        score_text = MAIN_FONT.render(f"Score: {self.game_info.score}", 1, (255, 255, 255))
-        WIN.blit(score_text, (10, HEIGHT - score_text.get_height() - 70))
+        score_text = renderer.text('score', f"Score: {self.game_info.score}")
+        renderer.blit(score_text, (10, HEIGHT - score_text.get_height() - 70))
 
-        time_text = MAIN_FONT.render(f"Time: {self.game_info.get_level_time()}s", 1, (255, 255, 255))
-        WIN.blit(time_text, (10, HEIGHT - time_text.get_height() - 40))
+        time_text = renderer.text('time', f"Time: {self.game_info.get_level_time()}s")
+        renderer.blit(time_text, (10, HEIGHT - time_text.get_height() - 40))
 
-        vel_text = MAIN_FONT.render(f"Vel: {round(self.player_car.vel, 1)}px/s", 1, (255, 255, 255))
-        WIN.blit(vel_text, (10, HEIGHT - vel_text.get_height() - 10))
+        vel_text = renderer.text('vel', f"Vel: {round(self.player_car.vel, 1)}px/s")
+        renderer.blit(vel_text, (10, HEIGHT - vel_text.get_height() - 10))
 
         #WIN.blit(self.reward_gates.return_active(), (0,0))
 
-        self.player_car.draw(WIN)
+        renderer.mark([self.player_car.draw(WIN)])
+        return renderer.end()
 
-    def handle_collision(self):
-        """
-        Check for collision between car and track border
-        """
-        bounce_flag = 0
-
-        if self.MANUAL_CONTROL:
-            if self.player_car.collide(TRACK_BORDER_MASK) != None:
-                self.player_car.bounce()
-                # Add a delay after bounce (where no input allowed)
-                bounce_flag = 6
-        else:
-            if self.player_car.collide(TRACK_BORDER_MASK) != None:
-                self.player_car.dead = True
-
-        return bounce_flag
-    
-    def game_reset(self):
-        """
-        Reset all elements of the game
-        """
-        self.player_car.reset()
-        self.player_car.dead = False
-        self.game_info.reset()
-        self.reward_gates.reset()
-        self.gate_count = 0
-        
     def detect_input(self):
         """
         Detect the manual input and assign appropriate action number.
@@ -163,69 +152,3 @@ class Game:
         self.game_loop(action_no)
 
         return run
-    
-    def game_loop(self, action_no):
-        """
-        Given a set action number, iterate the game state by one tick.
-        """
-        self.reward = -1
-
-        if self.player_car.bounce_flag > 0:
-            # Overwrite player input to "Do Nothing"
-            self.player_car.bounce_flag -= 1
-            action_no = 9
-
-        self.player_car.take_action(action_no)
-
-        if abs(self.player_car.vel) < 0.1: # Incentivize speed!
-            self.reward = -5
-        elif abs(self.player_car.vel) < 1:
-            self.reward = -3
-        passed = self.reward_gates.passed_gate(self.player_car, self.game_info)
-        if passed:
-            # print(f"Reward gate passed!- {self.reward_gates.active_gate}")
-            self.reward = 25
-            self.gate_count += 1
-
-        if self.player_car.bounce_flag == 0:
-            self.player_car.bounce_flag = self.handle_collision()
-
-        # Updating the car img is done after detecting collision etc as model was trained (erroneously)
-        # with it this way around. For correct behaviour, the update_car_img should really be in the
-        # player_car.rotate function call
-        self.player_car.update_car_img()
-
-        return
-    
-    def game_state(self):
-        distances = self.beam_sensors.beam_distances(self.player_car)
-
-        gate_dist = self.reward_gates.distance_to_gate(self.player_car.x, self.player_car.y)
-        gate_angle = self.reward_gate_angle()
-
-        model_input = distances
-        model_input.append(self.player_car.vel)
-        model_input.append(self.player_car.driftMomentum)
-        model_input.append(gate_dist)
-        model_input.append(gate_angle)
-
-        done = self.game_finished()
-        if done:
-            self.reward = -100
-        return model_input, self.reward, done
-    
-    def game_finished(self):
-        return self.player_car.dead
-    
-    def reward_gate_angle(self):
-        """
-        Calculate the angle from forward of car to centroid of next reward gate.
-        """
-        angle = self.reward_gates.angle_to_gate(self.player_car.x, self.player_car.y)
-        angle = angle - self.player_car.angle
-        angle = angle % 360
-        if angle > 180:
-            angle -= 360
-        elif angle < -179:
-            angle += 360
-        return angle
\ No newline at end of file
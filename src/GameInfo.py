@@ -7,6 +7,26 @@ class GameInfo:
     def reset(self):
         self.level_start_time = time.time()
         self.score = 0
+        self.ticks = 0
+
+    def tick(self):
+        """
+        Advance the game by one tick.
+        """
+        self.ticks += 1
+
+    def get_level_time(self):
+        return round(time.time() - self.level_start_time, 1)
+
+
+class TickGameInfo(GameInfo):
+    """
+    GameInfo driven by a simulated clock rather than the wall clock. Each game tick
+    advances the level time by 1/fps seconds, however fast the simulation is running.
+    """
+    def __init__(self, fps=30):
+        self.fps = fps
+        super().__init__()
 
     def get_level_time(self):
-        return round(time.time() - self.level_start_time, 1)
\ No newline at end of file
+        return round(self.ticks / self.fps, 1)
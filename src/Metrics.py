@@ -0,0 +1,62 @@
+import os
+import json
+import time
+import atexit
+
+
+class MetricsLog:
+    """
+    Append-only JSON lines log of training metrics (one record per call of log). Records
+    are buffered in memory and written every flush_every records or flush_seconds seconds,
+    whichever comes first, so there is no I/O per step. The log is split over files
+    name-000.jsonl, name-001.jsonl, ... with a new file started once one reaches
+    max_bytes, so a long run can be read back (or plotted) a file at a time.
+    """
+    def __init__(self, directory, name='metrics', flush_every=25, flush_seconds=60.0,
+                 max_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.name = name
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        # Carry on appending to the newest file of a previous run
+        existing = [f for f in os.listdir(directory) if f.startswith(name + '-') and f.endswith('.jsonl')]
+        self.index = max((int(f[len(name) + 1:-len('.jsonl')]) for f in existing), default=0)
+        atexit.register(self.flush)
+
+    def path(self, index):
+        return os.path.join(self.directory, f"{self.name}-{index:03d}.jsonl")
+
+    def log(self, **values):
+        """
+        Add a record (values must be numbers, strings or NumPy scalars).
+        """
+        values['time'] = time.time()
+        self.buffer.append(values)
+        if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            lines = ''.join(json.dumps(record, default=to_json) + '\n' for record in self.buffer)
+            path = self.path(self.index)
+            if os.path.exists(path) and os.path.getsize(path) + len(lines) > self.max_bytes:
+                self.index += 1
+                path = self.path(self.index)
+            with open(path, 'a') as f:
+                f.write(lines)
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+
+def to_json(value):
+    """
+    Convert NumPy scalars (which json cannot encode) to Python numbers.
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Cannot write {type(value).__name__} to the metrics log")
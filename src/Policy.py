@@ -0,0 +1,55 @@
+import numpy as np
+
+# Dense layers of the network built by ddqn.build_dqn, in order
+LAYERS = ('fc_layer1', 'fc_layer2', 'output_layer')
+
+
+class NumpyPolicy:
+    """
+    Forward pass of the Q network (12 -> 32 -> 32 -> 9, relu) in plain NumPy. For a single
+    state this takes microseconds, where keras predict takes milliseconds, and it does not
+    need TensorFlow at all when the weights are read straight from the saved h5 file.
+    """
+    def __init__(self, weights):
+        self.set_weights(weights)
+
+    @classmethod
+    def from_h5(cls, fname):
+        """
+        Read the weights of a model saved by DDQNAgent.save_model (needs h5py only).
+        """
+        import h5py
+
+        weights = []
+        with h5py.File(fname, 'r') as f:
+            for layer in LAYERS:
+                # Datasets sit in a sub group named after the layer, e.g. fc_layer1/fc_layer1/kernel:0
+                found = {}
+                def collect(name, obj):
+                    if isinstance(obj, h5py.Dataset):
+                        found[name.split('/')[-1].split(':')[0]] = obj[()]
+                f['model_weights'][layer].visititems(collect)
+                weights += [found['kernel'], found['bias']]
+        return cls(weights)
+
+    def set_weights(self, weights):
+        """
+        weights = [kernel, bias] of each layer, as returned by keras model.get_weights()
+        """
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+
+    def q_values(self, states):
+        """
+        Q values of a single state (n_actions,) or a batch of states (N, n_actions).
+        """
+        kernel1, bias1, kernel2, bias2, kernel3, bias3 = self.weights
+        x = np.asarray(states, dtype=np.float32)
+        x = np.maximum(x @ kernel1 + bias1, 0)
+        x = np.maximum(x @ kernel2 + bias2, 0)
+        return x @ kernel3 + bias3
+
+    def choose_action(self, state):
+        return np.argmax(self.q_values(state))
+
+    def choose_actions(self, states):
+        return np.argmax(self.q_values(states), axis=1)
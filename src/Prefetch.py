@@ -0,0 +1,67 @@
+import queue
+import threading
+
+
+class BatchPrefetcher:
+    """
+    Samples minibatches from a PrioritisedMemory on a worker thread, so the next batches
+    are ready while the learner runs its current gradient step. Up to depth prepared
+    batches wait in a bounded queue. Priority updates from the learner are queued too,
+    and the worker applies them (in order) before sampling its next batch.
+
+    Staleness: a batch popped by the learner was sampled before the priority updates
+    of at most the depth + 1 preceding learner steps had been applied. In the meantime
+    a sampled slot may also be overwritten by a new transition, in which case its update
+    lands on the new transition.
+    """
+    def __init__(self, memory, batch_size, lock, prepare=None, depth=2):
+        """
+        lock = lock held by everything else that touches the memory (storing transitions,
+               checkpoints), which the worker holds while it samples
+        prepare = function applied to each sample_buffer result on the worker thread
+                  (e.g. to convert it into the arrays the learner wants)
+        """
+        self.memory = memory
+        self.batch_size = batch_size
+        self.prepare = prepare if prepare is not None else (lambda sample: sample)
+        self.lock = lock
+        self.batches = queue.Queue(maxsize=depth)
+        self.updates = queue.Queue()
+        self.error = None
+
+        self.worker = threading.Thread(target=self.sample_loop, name='batch-prefetcher', daemon=True)
+        self.worker.start()
+
+    def sample_loop(self):
+        try:
+            while True:
+                with self.lock:
+                    self.apply_updates()
+                    sample = self.memory.sample_buffer(self.batch_size)
+                self.batches.put(self.prepare(sample))
+        except Exception as e:
+            self.error = e
+            self.batches.put(None)
+
+    def apply_updates(self):
+        while True:
+            try:
+                treeIndexes, absoluteErrors = self.updates.get_nowait()
+            except queue.Empty:
+                return
+            self.memory.batchUpdate(treeIndexes, absoluteErrors)
+
+    def get(self):
+        """
+        Pop the next prepared batch, waiting for the worker if none is ready.
+        """
+        batch = self.batches.get()
+        if batch is None:
+            raise RuntimeError("Sampling batches failed") from self.error
+        return batch
+
+    def update(self, treeIndexes, absoluteErrors):
+        """
+        Queue a priority update (see PrioritisedMemory.batchUpdate).
+        """
+        self.updates.put((treeIndexes, absoluteErrors))
@@ -0,0 +1,78 @@
+import time
+
+
+class Phase:
+    """
+    Context manager adding the time spent inside it to a phase of a Profiler.
+    """
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        profiler.totals[self.name] = profiler.totals.get(self.name, 0.0) + time.perf_counter() - self.start
+        profiler.counts[self.name] = profiler.counts.get(self.name, 0) + 1
+        return False
+
+
+class NoPhase:
+    """
+    Context manager that does nothing, used while profiling is disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+
+class Profiler:
+    """
+    Accumulates the wall time and number of calls of named phases of the hot path, e.g.
+        with PROFILER.phase('env.sensors'):
+            ...
+    Disabled by default, in which case phase returns a shared do-nothing context manager,
+    so the instrumentation costs a method call and an empty with block. Phases can be
+    nested, in which case the inner phase is also counted in the time of the outer one.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.counts = {}
+
+    def phase(self, name):
+        if self.enabled:
+            return Phase(self, name)
+        return NO_PHASE
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+
+    def report(self, reset=True):
+        """
+        Breakdown of the time in each phase since the last reset, as a printable table.
+        """
+        lines = [f"{'phase':24s} {'total s':>9s} {'calls':>8s} {'mean us':>10s}"]
+        for name in sorted(self.totals):
+            total, count = self.totals[name], self.counts[name]
+            lines.append(f"{name:24s} {total:9.3f} {count:8d} {total / count * 1e6:10.1f}")
+        if reset:
+            self.reset()
+        return '\n'.join(lines)
+
+
+# Shared by every module, enabled with e.g. main.py train --profile
+PROFILER = Profiler()
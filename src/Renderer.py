@@ -0,0 +1,72 @@
+import pygame
+
+
+class Renderer:
+    """
+    Draws frames onto a window by redrawing only what has changed. The static layers
+    (e.g. background and track) are composited once. Each frame, the areas drawn over in
+    the last frame are restored from that composite before the new frame is drawn, and
+    only those areas and the ones drawn over now need updating on the display. Rendered
+    text is cached until its value changes.
+
+    Per frame:
+        renderer.begin()
+        renderer.blit(...) / renderer.mark(rects drawn some other way)
+        pygame.display.update(renderer.end())
+    """
+    def __init__(self, window, layers, font):
+        """
+        layers = static (image, position) pairs, composited in order
+        font = pygame font used for text
+        """
+        self.window = window
+        self.static = pygame.Surface(window.get_size()).convert()
+        for img, pos in layers:
+            self.static.blit(img, pos)
+        self.font = font
+        self.texts = {} # Label -> (string, rendered surface)
+        self.drawn = [] # Rects of the window drawn over this frame
+        self.last_drawn = None # Rects drawn over in the last frame (None until the first)
+
+    def begin(self):
+        """
+        Start a frame, restoring the static layers wherever the last frame drew.
+        """
+        if self.last_drawn is None:
+            self.window.blit(self.static, (0, 0))
+        else:
+            for rect in self.last_drawn:
+                self.window.blit(self.static, rect, rect)
+        self.drawn = []
+
+    def blit(self, surface, pos):
+        self.drawn.append(self.window.blit(surface, pos))
+
+    def mark(self, rects):
+        """
+        Record areas of the window drawn over other than with blit (e.g. by pygame.draw).
+        """
+        self.drawn.extend(rects)
+
+    def text(self, label, string, color=(255, 255, 255)):
+        """
+        The string rendered as a surface, only rendered again when the string under this
+        label changes.
+        """
+        cached = self.texts.get(label)
+        if cached is None or cached[0] != string:
+            cached = (string, self.font.render(string, 1, color))
+            self.texts[label] = cached
+        return cached[1]
+
+    def end(self):
+        """
+        Finish the frame. Returns the rects of the window that have changed, to pass to
+        pygame.display.update (the whole window the first time).
+        """
+        if self.last_drawn is None:
+            changed = [self.window.get_rect()]
+        else:
+            changed = self.last_drawn + self.drawn
+        self.last_drawn = self.drawn
+        return changed
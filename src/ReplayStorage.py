@@ -0,0 +1,56 @@
+import os
+import json
+import numpy as np
+
+
+class MemmapStorage:
+    """
+    Directory of memory-mapped .npy arrays plus a small JSON header, used as an on-disk
+    backend for the replay memory. Arrays are opened in place rather than loaded, so
+    resuming is instant, the OS pages rows in (and out) on demand, and the memory can be
+    larger than the RAM of the machine.
+    """
+    HEADER = 'header.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.arrays = {}
+
+        header_path = os.path.join(directory, self.HEADER)
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                self.header = json.load(f)
+        else:
+            self.header = {}
+
+    def array(self, name, shape, dtype):
+        """
+        Open the named array, creating it (zero filled) if it does not exist yet.
+        """
+        path = os.path.join(self.directory, name + '.npy')
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        if os.path.exists(path):
+            arr = np.load(path, mmap_mode='r+')
+            if arr.shape != shape or arr.dtype != np.dtype(dtype):
+                raise ValueError(f"{path} holds a {arr.dtype} array of shape {arr.shape}, "
+                                 f"expected {np.dtype(dtype)} {shape}")
+        else:
+            arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        self.arrays[name] = arr
+        return arr
+
+    def flush(self, **header):
+        """
+        Write any changed pages of every array to disk, then update the header (atomically,
+        so it always describes arrays that have been fully flushed).
+        """
+        for arr in self.arrays.values():
+            arr.flush()
+
+        self.header.update(header)
+        self.header['dtypes'] = {name: arr.dtype.str for name, arr in self.arrays.items()}
+        header_path = os.path.join(self.directory, self.HEADER)
+        with open(header_path + '.tmp', 'w') as f:
+            json.dump(self.header, f, indent=1)
+        os.replace(header_path + '.tmp', header_path)
@@ -1,31 +1,71 @@
 import pygame
 import math
+import numpy as np
 
 from src.utils import scale_image
 from src.Cars import PlayerCar
 from src.GameInfo import GameInfo
-from src.utils import distance_between_points
+from src.utils import distance_between_points, surface_to_grid, segments_cross
 
 START_GATE = 0
+GATE_MARGIN = 10 # px to extend each end of a gate line by, so clipping it with the car counts
+
+
+def gate_segment(gate, margin=GATE_MARGIN):
+    """
+    End points of the line across the track drawn in a reward gate image - the extremes
+    of its pixels along their principal axis (extended by margin at both ends).
+    """
+    ys, xs = np.nonzero(surface_to_grid(gate))
+    points = np.column_stack([xs, ys]).astype(np.float64)
+    centre = points.mean(axis=0)
+    _, _, axes = np.linalg.svd(points - centre, full_matrices=False)
+    along = (points - centre) @ axes[0]
+    return np.array([centre + axes[0] * (along.min() - margin),
+                     centre + axes[0] * (along.max() + margin)])
 
 class RewardGate:
-    def __init__(self):
+    def __init__(self, assets=None):
+        """
+        assets = compiled TrackAssets to take the gate centroids and lines from, in which
+                 case the gate images are only loaded if they are asked for
+        """
         self.no_of_gates = 13
-        # Provide list of reward gate image file
-        self.reward_gate = [None] * self.no_of_gates
-        for i in range(1, self.no_of_gates+1):
-            fname = f"imgs/reward-gates/RewardGate{i}.png"
-            self.reward_gate[i-1] = scale_image(pygame.image.load(fname), 0.9)
+        self._reward_gate = None
+        self._reward_gate_masks = None
+        # Gates are static, so find their masks, centroids and lines once rather than every tick
+        if assets is not None:
+            self.gate_centroids = assets.gate_centroids
+            self.gate_segments = assets.gate_segments
+        else:
+            self.gate_centroids = [mask.centroid() for mask in self.reward_gate_masks]
+            self.gate_segments = np.array([gate_segment(gate) for gate in self.reward_gate])
         # Set activate gate to first one
         self.reset()
 
+    @property
+    def reward_gate(self):
+        # Provide list of reward gate image file
+        if self._reward_gate is None:
+            self._reward_gate = [None] * self.no_of_gates
+            for i in range(1, self.no_of_gates+1):
+                fname = f"imgs/reward-gates/RewardGate{i}.png"
+                self._reward_gate[i-1] = scale_image(pygame.image.load(fname), 0.9)
+        return self._reward_gate
+
+    @property
+    def reward_gate_masks(self):
+        if self._reward_gate_masks is None:
+            self._reward_gate_masks = [pygame.mask.from_surface(gate) for gate in self.reward_gate]
+        return self._reward_gate_masks
+
     def return_active(self):
         # return img of activate gate
         return self.reward_gate[self.active_gate]
     
     def return_active_mask(self):
         # return mask of activate gate
-        return pygame.mask.from_surface(self.return_active())
+        return self.reward_gate_masks[self.active_gate]
     
     def reset(self):
         """
@@ -44,7 +84,7 @@ class RewardGate:
         """
         Identify the central point of the current active reward gate.
         """
-        return self.return_active_mask().centroid()
+        return self.gate_centroids[self.active_gate]
     
     def distance_to_gate(self, x, y):
         """
@@ -66,9 +106,12 @@ class RewardGate:
         """
         Check whether the player car has passed the currently
         active reward gate. Increment score if so.
+        The path of the car center over its last move is tested against the gate line,
+        so a fast car cannot skip over a gate between ticks.
         """
-        gate_mask = self.return_active_mask()
-        if player_car.collide(gate_mask) != None:
+        gate_start, gate_end = self.gate_segments[self.active_gate]
+        if segments_cross((player_car.prev_x, player_car.prev_y), (player_car.x, player_car.y),
+                          gate_start, gate_end):
             game_info.score += 1
             self.increment_gate()
             return True
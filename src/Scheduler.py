@@ -0,0 +1,65 @@
+import time
+
+
+class TrainingScheduler:
+    """
+    Decides when the learner trains, relative to the environment steps taken:
+        train_every = train once every K environment steps
+        gradient_steps = learner steps per train, each on a batch of a single stacked sample
+        warmup = no training until the memory holds this many transitions
+        target_sync = update the target network every N learner steps (0 to leave it to
+                      the agent's replace_target)
+    So the update-to-data ratio is gradient_steps / train_every. The achieved rates of
+    both kinds of step are measured, see rates.
+    """
+    def __init__(self, train_every=1, gradient_steps=1, warmup=0, target_sync=0):
+        self.train_every = train_every
+        self.gradient_steps = gradient_steps
+        self.warmup = warmup
+        self.target_sync = target_sync
+
+        self.env_steps = 0
+        self.learner_steps = 0
+        self.train_calls = 0 # Train calls that have been due (taken or skipped during warmup)
+        self.last_rates = (time.perf_counter(), 0, 0)
+
+    def observe(self, env_steps=1):
+        """
+        Record environment steps that have been taken.
+        """
+        self.env_steps += env_steps
+
+    def due(self):
+        """
+        Number of train calls due for the environment steps taken so far.
+        """
+        return self.env_steps // self.train_every - self.train_calls
+
+    def train(self, agent, limit=None):
+        """
+        Make the train calls that are due (at most limit of them), then sync the target
+        network if it is due. Returns the number of learner steps taken.
+        """
+        calls = self.due() if limit is None else min(self.due(), limit)
+        taken = 0
+        for _ in range(max(calls, 0)):
+            self.train_calls += 1
+            if agent.memory.mem_count < self.warmup:
+                continue
+            taken += agent.train(self.gradient_steps)
+
+        if self.target_sync and taken:
+            if self.learner_steps // self.target_sync < (self.learner_steps + taken) // self.target_sync:
+                agent.update_network_parameters()
+        self.learner_steps += taken
+        return taken
+
+    def rates(self):
+        """
+        Environment and learner steps per second since the last call.
+        """
+        now = time.perf_counter()
+        then, env_steps, learner_steps = self.last_rates
+        elapsed = max(now - then, 1e-9)
+        self.last_rates = (now, self.env_steps, self.learner_steps)
+        return (self.env_steps - env_steps) / elapsed, (self.learner_steps - learner_steps) / elapsed
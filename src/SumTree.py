@@ -1,36 +1,66 @@
+import os
 import numpy as np
 
+def allocate_zeros(name, shape, dtype):
+    return np.zeros(shape, dtype=dtype)
+
+
 class SumTree:
-    def __init__(self, capacity):
+    def __init__(self, capacity, allocate=allocate_zeros):
+        """
+        allocate = function(name, shape, dtype) returning a zeroed array for the tree to use
+                   (e.g. MemmapStorage.array to keep the tree on disk)
+        """
         self.capacity = capacity
         self.size = 2 * capacity - 1
-        self.tree = np.zeros(self.size)
-        self.data = np.zeros(capacity, dtype=int)
+        self.tree = allocate('tree', self.size, np.float64)
+        # Same layout as tree, but each node holds the min of its leaves (only used to scale
+        # the IS weights, so single precision is plenty)
+        self.minTree = allocate('treeMin', self.size, np.float32)
+        self.minPending = [] # Leaves whose ancestors in the min tree are yet to be updated (see sync_min_tree)
         self.dataPointer = 0
         self.indexOfFirstData = capacity - 1
 
     """
-    adds a new element to the sub tree (or overwrites an old one) and updates all effected nodes 
+    adds a new element to the sub tree (or overwrites an old one) and updates all effected nodes.
+    The data of each leaf is its slot in the memory, which is just its position among the leaves
     """
 
-    def add(self, priority, data):
+    def add(self, priority):
         treeIndex = self.indexOfFirstData + self.dataPointer
 
-        # overwrite data
-
-        self.data[self.dataPointer] = data
         self.update(treeIndex, priority)
         self.dataPointer += 1
         self.dataPointer = self.dataPointer % self.capacity
 
+    """
+    leaves the next leaf as it is and moves on to the one after (e.g. to keep a leaf
+    which has been excluded)
+    """
+
+    def skip(self):
+        self.dataPointer += 1
+        self.dataPointer = self.dataPointer % self.capacity
+
+    """
+    sets the priority of the indexed leaf to zero, so it can never be sampled, and leaves
+    it out of the min tree
+    """
+
+    def exclude(self, index):
+        self.update(index, 0)
+        self.minTree[index] = np.inf
+
     """
     updates the priority of the indexed leaf as well as updating the value of all effected
-    elements in the sum tree
+    elements in the sum tree (the min tree above the leaf is left for sync_min_tree)
     """
 
     def update(self, index, priority):
         change = priority - self.tree[index]
         self.tree[index] = priority
+        self.minTree[index] = priority
+        self.minPending.append(index)
 
         while index != 0:
             # set index to parent
@@ -55,19 +85,115 @@ class SumTree:
         treeIndex = parent
         dataIndex = parent - self.indexOfFirstData
 
-        return treeIndex, self.tree[treeIndex], self.data[dataIndex]
+        return treeIndex, self.tree[treeIndex], dataIndex
+
+    """
+    batched version of update - sets the priority of several leaves at once and then
+    recomputes their ancestors one level at a time (a repeated leaf takes its last priority)
+    """
+
+    def update_many(self, indices, priorities):
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
+
+        # Keep only the last update of each leaf, as applying them in order would
+        _, last = np.unique(indices[::-1], return_index=True)
+        keep = len(indices) - 1 - last
+        self.tree[indices[keep]] = priorities[keep]
+        self.minTree[indices[keep]] = priorities[keep]
+        # The min tree above leaves written by update is brought up to date on the way
+        self.update_ancestors(self.take_min_pending(indices[keep]))
+
+    """
+    recomputes the ancestors of the given nodes from their children, one level at a time,
+    in the min tree and (unless sums is False) the sum tree
+    """
+
+    def update_ancestors(self, nodes, sums=True):
+        # Parents are recomputed from both children, so shared ancestors come out right
+        # (leaves can sit at different depths, but every ancestor is recomputed again after
+        # the last of its updated descendants)
+        while len(nodes) > 0:
+            nodes = (nodes[nodes > 0] - 1) // 2
+            if sums:
+                self.tree[nodes] = self.tree[2 * nodes + 1] + self.tree[2 * nodes + 2]
+            self.minTree[nodes] = np.minimum(self.minTree[2 * nodes + 1], self.minTree[2 * nodes + 2])
+
+    """
+    the given leaves plus those written by update (and exclude) whose ancestors in the min
+    tree have not been updated yet, which are then counted as done
+    """
+
+    def take_min_pending(self, leaves=()):
+        leaves = np.asarray(leaves, dtype=np.int64)
+        if self.minPending:
+            leaves = np.concatenate([leaves, self.minPending])
+            self.minPending = []
+        return leaves
+
+    """
+    brings the min tree up to date with the leaves written by update (and exclude) since
+    it was last synced - batched, so the cost of keeping the min tree is paid once per
+    sample rather than on every write
+    """
+
+    def sync_min_tree(self):
+        self.update_ancestors(self.take_min_pending(), sums=False)
+
+    """
+    batched version of getLeaf - descends the tree for every value at once, one level at
+    a time. Returns arrays of tree indexes, priorities and data
+    """
+
+    def get_leaves(self, values):
+        values = np.array(values, dtype=np.float64)
+        nodes = np.zeros(len(values), dtype=np.int64)
+
+        while True:
+            LChild = 2 * nodes + 1
+            descend = LChild < self.size
+            if not descend.any():
+                break
+            LValues = self.tree[np.minimum(LChild, self.size - 1)]
+            goLeft = LValues >= values
+            values = np.where(descend & ~goLeft, values - LValues, values)
+            nodes = np.where(descend, np.where(goLeft, LChild, LChild + 1), nodes)
+
+        dataIndexes = nodes - self.indexOfFirstData
+        return nodes, self.tree[nodes], dataIndexes
 
     def total_priority(self):
         return self.tree[0]  # Returns the root node
+
+    def min_priority(self):
+        self.sync_min_tree()
+        return self.minTree[0]  # Lowest priority of any leaf (including empty ones)
+
+    """
+    rebuilds the min tree from the leaves of the sum tree, deepest level first
+    """
+
+    def rebuild_min_tree(self):
+        self.minTree[:] = self.tree # In place, in case the tree lives on disk
+        self.minPending = []
+        depth = int(np.log2(self.size))
+        for level in range(depth, -1, -1):
+            nodes = np.arange(2 ** level - 1, min(2 ** (level + 1) - 1, self.indexOfFirstData))
+            self.minTree[nodes] = np.minimum(self.minTree[2 * nodes + 1], self.minTree[2 * nodes + 2])
     
     def save_tree(self, filename):
+        self.sync_min_tree()
         np.save(filename + '_tree', self.tree)
-        np.save(filename + '_treeData', self.data, allow_pickle=True)
+        np.save(filename + '_treeMin', self.minTree)
 
         return self.dataPointer
     
     def load_tree(self, filename, dataPointer):
         self.dataPointer = dataPointer
+        self.minPending = []
 
         self.tree = np.load(filename + '_tree.npy')
-        self.data = np.load(filename + '_treeData.npy', allow_pickle=True)
\ No newline at end of file
+        if os.path.exists(filename + '_treeMin.npy'):
+            self.minTree = np.load(filename + '_treeMin.npy').astype(np.float32)
+        else:
+            self.rebuild_min_tree() # Saved before the min tree existed
\ No newline at end of file
@@ -0,0 +1,225 @@
+import os
+import json
+import numpy as np
+
+from src.Checkpoint import atomic_write
+
+TRAJECTORY = 'model/trajectory.bin'
+ACTIONS = 'model/action_save.npy' # Actions of the run recorded before there were trajectory files
+EXPECTATIONS = 'model/playback_expectations.json' # Outcomes of replaying recordings, see first_divergence
+TRAJECTORY_VERSION = 1
+MAGIC = b'TRAJECTR'
+
+# Game state before each step (see Environment.snapshot), restored to seek to the step
+POSE_FIELDS = [('x', '<f8'), ('y', '<f8'), ('angle', '<f8'), ('vel', '<f8'), ('drift', '<f8'),
+               ('prev_x', '<f8'), ('prev_y', '<f8'), ('bounce_flag', '<i4'), ('dead', '?'),
+               ('active_gate', '<i4'), ('gate_count', '<i4'), ('score', '<i4'), ('ticks', '<i4')]
+
+
+def record_dtype(n_inputs):
+    """
+    Fixed size record of one step - where the episode was, the model input it saw, the
+    action taken and its outcome, and the game state to restore to replay from the step.
+    """
+    return np.dtype([('episode', '<u4'), ('step', '<u4'), ('state', '<f4', (n_inputs,)), ('action', 'u1'),
+                     ('reward', '<f4'), ('done', '?')] + POSE_FIELDS)
+
+
+class TrajectoryWriter:
+    """
+    Records steps to a trajectory file as they are taken. Steps are buffered into chunks of
+    chunk_steps records, and each chunk (and the end of every episode) is appended to the
+    file straight away, so a crash loses at most one chunk. An index of where each
+    episode starts is kept next to the file (see Trajectory).
+    """
+    def __init__(self, fname, n_inputs, chunk_steps=256):
+        self.fname = fname
+        self.dtype = record_dtype(n_inputs)
+        self.chunk = np.zeros(chunk_steps, dtype=self.dtype)
+        self.filled = 0
+        self.episode = 0
+        self.step = 0
+        self.records = 0 # Written to the file
+        self.episode_starts = []
+
+        header = json.dumps({'version': TRAJECTORY_VERSION, 'n_inputs': n_inputs}).encode()
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        if os.path.exists(index_path(fname)): # Left by an earlier recording
+            os.remove(index_path(fname))
+        self.file = open(fname, 'wb')
+        self.file.write(MAGIC + np.array([len(header)], dtype='<u4').tobytes() + header)
+
+    def append(self, snapshot, state, action, reward, done):
+        """
+        Add a step - the game snapshot and model input from before it, the action taken, and
+        the reward and done flag that came back.
+        """
+        if self.step == 0:
+            self.episode_starts.append(self.records + self.filled)
+        record = self.chunk[self.filled]
+        for name, value in snapshot.items():
+            record[name] = value
+        record['episode'], record['step'] = self.episode, self.step
+        record['state'], record['action'] = state, action
+        record['reward'], record['done'] = reward, done
+        self.filled += 1
+        self.step += 1
+        if self.filled == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.chunk[:self.filled].tobytes())
+        self.file.flush()
+        self.records += self.filled
+        self.filled = 0
+
+    def end_episode(self):
+        """
+        Write out the episode just finished (to disk, not only the OS) and update the index.
+        """
+        if self.step == 0:
+            return
+        self.flush()
+        os.fsync(self.file.fileno())
+        atomic_write(index_path(self.fname), lambda f: np.save(f, self.index()))
+        self.episode += 1
+        self.step = 0
+
+    def index(self):
+        """
+        First record and number of steps of each episode.
+        """
+        starts = np.array(self.episode_starts, dtype=np.int64)
+        return np.column_stack([starts, np.diff(np.append(starts, self.records + self.filled))])
+
+    def close(self):
+        self.end_episode()
+        self.file.close()
+
+
+def index_path(fname):
+    return fname + '.index.npy'
+
+
+class Trajectory:
+    """
+    Read-only view of a trajectory file. The records are memory-mapped, so opening a long
+    recording reads nothing but the header and index, and any step can be read directly.
+    A record cut short by a crash is ignored, as is an index that does not cover every
+    record (the index is then rebuilt from the step numbers).
+    """
+    def __init__(self, fname=TRAJECTORY):
+        with open(fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{fname} is not a trajectory file")
+            header_length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+            self.header = json.loads(f.read(header_length))
+        if self.header['version'] != TRAJECTORY_VERSION:
+            raise ValueError(f"{fname} is a version {self.header['version']} trajectory, "
+                             f"expected version {TRAJECTORY_VERSION}")
+
+        self.dtype = record_dtype(self.header['n_inputs'])
+        offset = len(MAGIC) + 4 + header_length
+        n_records = (os.path.getsize(fname) - offset) // self.dtype.itemsize
+        self.records = np.memmap(fname, dtype=self.dtype, mode='r', offset=offset, shape=(n_records,)) \
+                       if n_records else np.zeros(0, dtype=self.dtype)
+
+        index = np.load(index_path(fname)) if os.path.exists(index_path(fname)) else np.zeros((0, 2), np.int64)
+        if index[:, 1].sum() != n_records:
+            starts = np.flatnonzero(self.records['step'] == 0)
+            index = np.column_stack([starts, np.diff(np.append(starts, n_records))])
+        self.index = index
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def n_episodes(self):
+        return len(self.index)
+
+    def episode(self, episode):
+        """
+        Records of the steps of an episode, in order.
+        """
+        start, length = self.index[episode]
+        return self.records[start:start + length]
+
+
+def default_recording():
+    """
+    The recording to play back when none is given - the last one recorded, or the run of
+    actions that comes with the repository if nothing has been recorded yet.
+    """
+    return TRAJECTORY if os.path.exists(TRAJECTORY) else ACTIONS
+
+
+def load_recording(fname):
+    """
+    Episodes of a recording, as (actions, records) pairs - records is None for a .npy file
+    of actions (as recorded before there were trajectory files).
+    """
+    if fname.endswith('.npy'):
+        return [(np.load(fname), None)]
+    trajectory = Trajectory(fname)
+    return [(records['action'], records) for records in map(trajectory.episode, range(trajectory.n_episodes))]
+
+
+def replay(env, actions, records=None, inputs=False):
+    """
+    Re-simulate an episode from the start by taking its actions on env, as fast as the
+    CPU allows. If the records of the episode are given, every step is compared with
+    them, stopping at the first that differs.
+    inputs = also compute the model input of every step (and compare it with the recorded
+             one) - the sensors are otherwise skipped, as nothing else depends on them
+    Returns the outcome - the number of steps, gate_count and the steps each gate was
+    passed on - and the first mismatch, as (step, description), or None.
+    """
+    env.game_reset()
+    state = env.game_state()[0] if inputs else None
+    gate_steps = []
+    for step, action in enumerate(actions):
+        if records is not None:
+            differ = compare_step(env.snapshot(), state, records[step])
+            if differ:
+                outcome = {'steps': step, 'gate_count': env.gate_count, 'gate_steps': gate_steps}
+                return outcome, (step, 'recorded ' + ', '.join(differ) + ' differ')
+        env.game_loop(int(action) + 1)
+        if inputs:
+            state, reward, done = env.game_state()
+        else:
+            reward, done = env.outcome()
+        if env.gate_count > len(gate_steps):
+            gate_steps.append(step)
+        if records is not None and (reward != records[step]['reward'] or done != records[step]['done']):
+            outcome = {'steps': step + 1, 'gate_count': env.gate_count, 'gate_steps': gate_steps}
+            return outcome, (step, f"reward {reward} (done {done}), recorded {records[step]['reward']:g} "
+                                   f"(done {records[step]['done']})")
+    return {'steps': len(actions), 'gate_count': env.gate_count, 'gate_steps': gate_steps}, None
+
+
+def compare_step(snapshot, state, record):
+    """
+    Names of the values of a recorded step that differ from the simulated game snapshot and
+    model input (None to skip it) before the step.
+    """
+    differ = [name for name, value in snapshot.items() if value != record[name]]
+    if state is not None and not np.array_equal(np.asarray(state, dtype=np.float32), record['state'], equal_nan=True):
+        differ.append('state')
+    return differ
+
+
+def first_divergence(expected, outcome):
+    """
+    The first step at which the outcome of a replay differs from the expected one, as
+    (step, description), or None if they match.
+    """
+    expected_steps, gate_steps = expected['gate_steps'], outcome['gate_steps']
+    for gate, (expected_step, step) in enumerate(zip(expected_steps, gate_steps)):
+        if expected_step != step:
+            return min(expected_step, step), f"gate {gate + 1} passed at step {step}, expected step {expected_step}"
+    if len(expected_steps) != len(gate_steps):
+        step = max(expected_steps, gate_steps, key=len)[min(len(expected_steps), len(gate_steps))]
+        return step, f"{len(gate_steps)} gates passed, expected {len(expected_steps)}"
+    if expected['steps'] != outcome['steps']:
+        return min(expected['steps'], outcome['steps']), f"{outcome['steps']} steps, expected {expected['steps']}"
+    return None
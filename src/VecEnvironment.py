@@ -0,0 +1,193 @@
+import numpy as np
+
+from src.utils import surface_to_grid, segments_cross
+from src.Cars import PlayerCar
+from src.RewardGates import RewardGate, START_GATE
+from src.Sensor import DistanceFieldSensor, BEAM_OFFSETS
+from src.Environment import load_track_border
+
+# Per-action flags for action indices 0-8 (i.e. action_no 1-9 in PlayerCar.take_action)
+#                      1  2  3  4  5  6  7  8  9
+ACTION_FORWARD = np.array([0, 0, 1, 0, 1, 1, 0, 0, 0], dtype=bool)
+ACTION_BACKWARD = np.array([0, 0, 0, 1, 0, 0, 1, 1, 0], dtype=bool)
+ACTION_LEFT = np.array([1, 0, 0, 0, 1, 0, 1, 0, 0], dtype=bool)
+ACTION_RIGHT = np.array([0, 1, 0, 0, 0, 1, 0, 1, 0], dtype=bool)
+# Just left/right (1, 2) only rotate the car while it is moving forwards
+ACTION_ROTATE_IF_MOVING = np.array([1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=bool)
+
+
+class VecEnvironment:
+    """
+    Batched version of Environment which steps N cars at once. The state of every car
+    (position, angle, velocity, drift momentum, active gate) is held in NumPy arrays and
+    the PlayerCar physics are applied to all of them in a handful of array operations.
+    Cars that crash (or run out of steps) are reset automatically.
+    """
+    def __init__(self, n_cars, max_steps=3600, max_vel=8, rotation_vel=5):
+        self.n_cars = n_cars
+        self.max_steps = max_steps
+        self.max_vel = max_vel
+        self.rotation_vel = rotation_vel
+        self.acceleration = 0.2
+        self.driftFriction = 0.75
+
+        # Static track geometry as occupancy grids indexed [y, x]
+        track_border = load_track_border()
+        self.border_grid = surface_to_grid(track_border)
+        self.HEIGHT, self.WIDTH = self.border_grid.shape
+        self.beam_sensors = DistanceFieldSensor(track_border)
+        reward_gates = RewardGate()
+        self.no_of_gates = reward_gates.no_of_gates
+        self.gate_segments = reward_gates.gate_segments
+        self.gate_centroids = np.array(reward_gates.gate_centroids, dtype=np.float64)
+
+        # Pixels of the car sprite relative to its center, used for collisions
+        car_grid = surface_to_grid(PlayerCar.IMG)
+        pixels = np.argwhere(car_grid)[:, ::-1].astype(np.float64)
+        self.car_pixels = pixels + 0.5 - np.array(car_grid.shape[::-1]) / 2
+
+        self.x = np.zeros(n_cars)
+        self.y = np.zeros(n_cars)
+        self.angle = np.zeros(n_cars)
+        self.vel = np.zeros(n_cars)
+        self.driftMomentum = np.zeros(n_cars)
+        self.active_gate = np.zeros(n_cars, dtype=np.int64)
+        self.gate_count = np.zeros(n_cars, dtype=np.int64)
+        self.steps = np.zeros(n_cars, dtype=np.int64)
+        # Observations of the cars that were reset on the last step (before resetting)
+        self.final_observations = np.zeros((0, 12), dtype=np.float32)
+
+    def reset(self):
+        """
+        Reset every car and return the (N, 12) observation matrix.
+        """
+        self.reset_cars(np.ones(self.n_cars, dtype=bool))
+        return self.observe()
+
+    def reset_cars(self, cars):
+        """
+        Reset the cars selected by the boolean array cars to the start of the track.
+        """
+        self.x[cars], self.y[cars] = PlayerCar.START_POS
+        self.angle[cars] = 0
+        self.vel[cars] = 0
+        self.driftMomentum[cars] = 0
+        self.active_gate[cars] = START_GATE
+        self.gate_count[cars] = 0
+        self.steps[cars] = 0
+
+    def step(self, actions):
+        """
+        Iterate every car by one tick, given an array of N action indices (0-8).
+        Returns the (N, 12) observations, rewards and done flags. Cars which are done
+        (or reach max_steps) are reset, so their returned observation is the first of
+        the next episode - the final observation is kept in self.final_observations.
+        """
+        actions = np.asarray(actions)
+        # Collisions are checked against the car pose from before the move, as in Environment
+        prev_x, prev_y, prev_angle = self.x.copy(), self.y.copy(), self.angle.copy()
+        prev_position = np.column_stack([prev_x, prev_y])
+
+        self.take_actions(actions)
+        self.steps += 1
+
+        rewards = np.full(self.n_cars, -1.0)
+        speed = np.abs(self.vel)
+        rewards[speed < 1] = -3
+        rewards[speed < 0.1] = -5
+
+        gates = self.gate_segments[self.active_gate]
+        passed = segments_cross(prev_position, np.column_stack([self.x, self.y]), gates[:, 0], gates[:, 1])
+        rewards[passed] = 25
+        self.gate_count += passed
+        self.active_gate = (self.active_gate + passed) % self.no_of_gates
+
+        points_x, points_y = self.car_points(prev_x, prev_y, prev_angle)
+        dones = self.border_grid[points_y, points_x].any(axis=1)
+        rewards[dones] = -100
+
+        observations = self.observe()
+        finished = dones | (self.steps >= self.max_steps)
+        self.final_observations = observations[finished]
+        if finished.any():
+            self.reset_cars(finished)
+            observations[finished] = self.observe()[finished]
+
+        return observations, rewards, dones
+
+    def take_actions(self, actions):
+        """
+        Apply PlayerCar.take_action to every car at once.
+        """
+        forward = ACTION_FORWARD[actions]
+        backward = ACTION_BACKWARD[actions]
+        left = ACTION_LEFT[actions]
+        right = ACTION_RIGHT[actions]
+        rotate = ~ACTION_ROTATE_IF_MOVING[actions] | (self.vel > 0)
+
+        # rotate
+        multiplier = np.where(np.abs(self.vel) > 5, np.abs(self.vel) / 5, 1)
+        turn = self.rotation_vel * multiplier * (left.astype(np.float64) - right)
+        self.angle += np.where(rotate, turn, 0)
+
+        # move_forward / move_backwards / reduce_speed
+        friction = ~(forward | backward)
+        vel = self.vel
+        vel = np.where(forward, np.minimum(vel + self.acceleration, self.max_vel), vel)
+        vel = np.where(backward, np.maximum(vel - self.acceleration, -self.max_vel / 2), vel)
+        vel = np.where(friction & (vel < 0), np.minimum(vel + self.acceleration / 2, 0), vel)
+        vel = np.where(friction & (vel >= 0), np.maximum(vel - self.acceleration / 2, 0), vel)
+        self.vel = vel
+
+        # move
+        driftAmount = np.where(self.vel < 5, 0, self.vel * self.rotation_vel / (9.0 * 8.0))
+        self.driftMomentum += driftAmount * (right.astype(np.float64) - left)
+
+        radians = np.radians(self.angle)
+        drift_radians = np.radians(self.angle + 90)
+        self.x -= self.vel * np.sin(radians) + self.driftMomentum * np.sin(drift_radians)
+        self.y -= self.vel * np.cos(radians) + self.driftMomentum * np.cos(drift_radians)
+
+        self.driftMomentum *= self.driftFriction
+
+    def car_points(self, x, y, angle):
+        """
+        Pixel coordinates covered by the car for each car, as two (N, P) index arrays.
+        """
+        radians = np.radians(angle)[:, np.newaxis]
+        c, s = np.cos(radians), np.sin(radians)
+        dx, dy = self.car_pixels[:, 0], self.car_pixels[:, 1]
+        # pygame.transform.rotate turns the sprite anticlockwise on screen
+        points_x = x[:, np.newaxis] + dx * c + dy * s
+        points_y = y[:, np.newaxis] - dx * s + dy * c
+        points_x = np.clip(points_x.astype(np.int64), 0, self.WIDTH - 1)
+        points_y = np.clip(points_y.astype(np.int64), 0, self.HEIGHT - 1)
+        return points_x, points_y
+
+    def beam_distances(self):
+        """
+        Cast the 8 sensor beams of every car. Returns an (N, 8) array of distances.
+        """
+        angles = BEAM_OFFSETS - self.angle[:, np.newaxis]
+        hit_x, hit_y = self.beam_sensors.cast(self.x[:, np.newaxis], self.y[:, np.newaxis], angles)
+        return np.round(np.hypot(hit_x - self.x[:, np.newaxis], hit_y - self.y[:, np.newaxis]), 1)
+
+    def observe(self):
+        """
+        Build the (N, 12) model input matrix for the current state of every car.
+        """
+        gate_x = self.gate_centroids[self.active_gate, 0]
+        gate_y = self.gate_centroids[self.active_gate, 1]
+        gate_dist = np.round(np.hypot(gate_x - self.x, gate_y - self.y), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gate_angle = np.degrees(np.arctan((gate_x - self.x) / (gate_y - self.y)))
+        gate_angle = np.nan_to_num(gate_angle - self.angle) % 360
+        gate_angle = np.where(gate_angle > 180, gate_angle - 360, gate_angle)
+
+        observations = np.empty((self.n_cars, 12), dtype=np.float32)
+        observations[:, :8] = self.beam_distances()
+        observations[:, 8] = self.vel
+        observations[:, 9] = self.driftMomentum
+        observations[:, 10] = gate_dist
+        observations[:, 11] = gate_angle
+        return observations
@@ -1,19 +1,27 @@
 from keras.layers import Dense, Activation
 from keras.models import Sequential, load_model
 from keras.optimizers import Adam
+import os
+import threading
 import numpy as np
-from keras import backend as kback
+import tensorflow as tf
 
 from src.ExperienceReplay import ExperienceBuffer, PrioritisedMemory
+from src.Checkpoint import Checkpointer
+from src.Policy import NumpyPolicy
+from src.Prefetch import BatchPrefetcher
+from src.Profiling import PROFILER
 
 
-def build_dqn(lr, n_actions, input_dims, fc1_dims, fc2_dims):
+def build_dqn(lr, n_actions, input_dims, fc1_dims, fc2_dims, compile_model=True):
     """
     lr = learning rate
     n_actions = no. of available actions in environment
     input_dims = no. of inputs given to model from environment
     fc1_dims = Dims. of first fully connected layer
     fc2_dims = Dims. of second fully connected layer
+    compile_model = give the model its optimizer and loss (not needed by a model that is
+                    only run forward, like the target network)
     """
     model = Sequential([
                 Dense(fc1_dims, activation='relu', input_shape=[input_dims, ], name="fc_layer1"),
@@ -21,7 +29,8 @@ def build_dqn(lr, n_actions, input_dims, fc1_dims, fc2_dims):
                 Dense(n_actions, name="output_layer")
             ])
         
-    model.compile(optimizer=Adam(learning_rate=lr), loss='mse')
+    if compile_model:
+        model.compile(optimizer=Adam(learning_rate=lr), loss='mse')
     return model
 
 
@@ -29,9 +38,22 @@ class DDQNAgent:
     def __init__(self, alpha, gamma, n_actions, epsilon, batch_size,
                  input_dims, epsilon_dec=0.00001, epsilon_end=0.01,
                  mem_size=100000, fname='ddqn_model.h5', replace_target=1000,
-                 parameter_fname = 'ddqn_model'):
-        """replace_target = how often to update the target model"""
+                 parameter_fname = 'ddqn_model', compact_memory=False, state_dtype=np.float32,
+                 memory_dir=None, checkpoint_dir=None, prefetch=0):
+        """
+        replace_target = how often to update the target model, in stored transitions (None to
+                         leave it to the caller, e.g. TrainingScheduler)
+        compact_memory = use the compact replay storage (single copy of each state, as
+                         state_dtype, and action indices) - about 4x less memory
+        memory_dir = keep the replay memory in memory-mapped files in this directory
+        checkpoint_dir = save the replay memory as incremental checkpoints in this directory,
+                         written in the background (see Checkpointer)
+        prefetch = no. of batches to sample ahead on a worker thread (0 to sample in train),
+                   see BatchPrefetcher for how stale they can be
+        """
         
+        self.alpha = alpha
+        self.input_dims = input_dims
         self.n_actions = n_actions
         self.action_space = [i for i in range(self.n_actions)] # e.g. [0, 1, 2, 3]
         self.gamma = gamma
@@ -47,13 +69,44 @@ class DDQNAgent:
         self.param_fname = parameter_fname
         self.replace_target = replace_target
         #self.memory = ExperienceBuffer(mem_size, input_dims, n_actions, True)
-        self.memory = PrioritisedMemory(mem_size, input_dims, n_actions, True)
+        self.memory = PrioritisedMemory(mem_size, input_dims, n_actions, True,
+                                        compact=compact_memory, state_dtype=state_dtype,
+                                        storage_dir=memory_dir)
+        self.checkpointer = Checkpointer(checkpoint_dir) if checkpoint_dir is not None else None
+        self.target_synced_at = self.memory.mem_count # Stored transitions at the last target network update
+        self.memory_lock = threading.Lock() # Held while using the memory, as the prefetcher may too
+        self.prefetch = prefetch
+        self.prefetcher = None # Started once there is enough in memory to sample
+
+        self._q_eval = None # The networks are built on first use, see q_eval and q_target
+        self._q_target = None
+        self.train_step = None # Compiled on first use (and again after loading q_eval)
+        self.policy = None # NumPy copy of q_eval used to choose actions, made on first use
+        self.policy_stale = True # Whether q_eval has changed since policy was synced
+        self.loss_total, self.td_error_total, self.learn_steps = 0.0, 0.0, 0 # See take_train_stats
 
-        self.q_eval = build_dqn(alpha, n_actions, input_dims, 32, 32)
-        self.q_target = build_dqn(alpha, n_actions, input_dims, 32, 32)
+    @property
+    def q_eval(self):
+        """
+        Online network, built and compiled on first use - so when load_model is called
+        first, the saved model is loaded without building one to throw away.
+        """
+        if self._q_eval is None:
+            self._q_eval = build_dqn(self.alpha, self.n_actions, self.input_dims, 32, 32)
+        return self._q_eval
+
+    @property
+    def q_target(self):
+        """
+        Target network, built on first use. It is only run forward, so is not compiled.
+        """
+        if self._q_target is None:
+            self._q_target = build_dqn(self.alpha, self.n_actions, self.input_dims, 32, 32, compile_model=False)
+        return self._q_target
 
     def remember(self, state, action, reward, new_state, done):
-        self.memory.store_transition(state, action, reward, new_state, done)
+        with self.memory_lock:
+            self.memory.store_transition(state, action, reward, new_state, done)
 
     def choose_action_train(self, state):
         """
@@ -68,51 +121,143 @@ class DDQNAgent:
         # Return index of chosen action - start from 0
         return action
     
+    def choose_actions_train(self, states):
+        """
+        Batched version of choose_action_train for an (N, input_dims) array of states
+        (e.g. from VecEnvironment), using a single forward pass for all of them.
+        """
+        actions = self.synced_policy().choose_actions(states)
+        explore = np.random.random(len(states)) < self.epsilon
+        actions[explore] = np.random.choice(self.action_space, np.count_nonzero(explore))
+        return actions
+
     def choose_action(self, state):
-        state = np.array(state).astype(np.float32)
-        state = state[np.newaxis,:]
-        actions = self.q_eval.predict(state, verbose=0)
-        action = np.argmax(actions)
-        del state
-        return action
+        return self.synced_policy().choose_action(state)
 
-    def train(self):
+    def synced_policy(self):
+        """
+        The NumPy copy of q_eval, updated with its weights if they have changed.
+        """
+        if self.policy_stale:
+            with PROFILER.phase('act.sync_policy'):
+                if self.policy is None:
+                    self.policy = NumpyPolicy(self.q_eval.get_weights())
+                else:
+                    self.policy.set_weights(self.q_eval.get_weights())
+            self.policy_stale = False
+        return self.policy
+
+    def train(self, gradient_steps=1):
+        """
+        Take gradient_steps learner steps, on one stacked sample of gradient_steps batches
+        from the memory (or on gradient_steps prefetched batches). Returns the number of
+        steps taken.
+        """
         # Instead of filling memory buffer with random input, don't train until buffer full
         if self.memory.mem_count > self.batch_size:
-            # state, action, reward, new_state, done = \
-            #         self.memory.sample_buffer(self.batch_size)
-            batchIndexes, state, action, reward, new_state, done, batchISWeights = \
-                        self.memory.sample_buffer(self.batch_size)
-            action_values = np.array(self.action_space, dtype=np.int8)
-            action_indices = np.dot(action, action_values)
+            if self.train_step is None:
+                self.train_step = self.build_train_step()
 
-            q_next = self.q_target.predict(new_state, verbose=0) # What reward would target model expect for each poss. action
-            q_eval = self.q_eval.predict(new_state, verbose=0)
+            if self.prefetch:
+                if self.prefetcher is None:
+                    self.prefetcher = BatchPrefetcher(self.memory, self.batch_size, self.memory_lock,
+                                                      self.prepare_batch, self.prefetch)
+                for _ in range(gradient_steps):
+                    with PROFILER.phase('learner.wait_batch'):
+                        batchIndexes, *batch = self.prefetcher.get()
+                    absError = self.learn(*batch)
+                    with PROFILER.phase('learner.priorities'):
+                        self.prefetcher.update(batchIndexes, absError)
+            else:
+                with PROFILER.phase('learner.sample'), self.memory_lock:
+                    batchIndexes, *batch = self.prepare_batch(
+                        self.memory.sample_buffer(self.batch_size * gradient_steps))
+                # The stratified sample is in order of priority mass, so shuffle it before slicing,
+                # or each minibatch would only cover one band of the sum tree
+                order = np.random.permutation(len(batchIndexes))
+                batchIndexes, batch = batchIndexes[order], [arr[order] for arr in batch]
+                absErrors = []
+                for start in range(0, len(batchIndexes), self.batch_size):
+                    rows = slice(start, start + self.batch_size)
+                    absErrors.append(self.learn(*[arr[rows] for arr in batch]))
+                with PROFILER.phase('learner.priorities'), self.memory_lock:
+                    self.memory.batchUpdate(batchIndexes, np.concatenate(absErrors))
 
-            q_pred = self.q_eval.predict(state, verbose=0) # Reward of each action that could have been taken
+            # Counted from the last update rather than on multiples of replace_target, which
+            # mem_count can step past (when training every few steps, or with actors)
+            if self.replace_target and self.memory.mem_count - self.target_synced_at >= self.replace_target:
+                with PROFILER.phase('learner.target_sync'):
+                    self.update_network_parameters()
+            return gradient_steps
+        return 0
 
-            max_actions = np.argmax(q_eval, axis=1) # What action would the live model suggest
+    def prepare_batch(self, sample):
+        """
+        Convert a sample from the memory into the tree indexes plus the arrays train_step takes.
+        """
+        batchIndexes, state, action, reward, new_state, done, batchISWeights = sample
+        if action.ndim == 1:
+            action_indices = action.astype(np.int64) # Compact memory stores indices
+        else:
+            action_values = np.array(self.action_space, dtype=np.int8)
+            action_indices = np.dot(action, action_values).astype(np.int64)
+        return (batchIndexes, state.astype(np.float32), action_indices, reward.astype(np.float32),
+                new_state.astype(np.float32), done.astype(np.float32), batchISWeights)
+
+    def learn(self, state, action, reward, new_state, done, batchISWeights):
+        """
+        One learner step on a prepared batch. Returns the absolute TD errors.
+        """
+        with PROFILER.phase('learner.step'):
+            absError = self.train_step(state, action, reward, new_state, done, batchISWeights).numpy()
+        self.policy_stale = True
+        self.update_epsilon()
+        self.epsilon_step += 1
+
+        # The loss of the step, as minimised by train_step
+        self.loss_total += float(np.mean(np.square(absError) * batchISWeights)) / self.n_actions
+        self.td_error_total += float(np.mean(absError))
+        self.learn_steps += 1
+        return absError
 
-            q_target = q_pred # To ensure diff only found for actions actually taken
+    def take_train_stats(self):
+        """
+        Mean loss and mean absolute TD error of the learner steps since the last call
+        (None if there have been none).
+        """
+        steps = self.learn_steps
+        stats = (self.loss_total / steps, self.td_error_total / steps) if steps else (None, None)
+        self.loss_total, self.td_error_total, self.learn_steps = 0.0, 0.0, 0
+        return stats
 
-            batch_index = np.arange(self.batch_size, dtype=np.int32)
+    def build_train_step(self):
+        """
+        Compile one learner step into a single graph call - the target and online forward
+        passes, the Double DQN target and the weighted gradient update of q_eval. Returns
+        the absolute TD error of each sample (for the memory priorities).
+        The loss matches fitting q_eval with loss='mse' towards its own predictions with
+        only the taken action replaced by the target, as train used to.
+        """
+        q_eval, q_target, gamma = self.q_eval, self.q_target, self.gamma
+        n_actions = float(self.n_actions)
+        batch = tf.TensorSpec([None, q_eval.input_shape[1]], tf.float32)
+        vector = tf.TensorSpec([None], tf.float32)
 
-            q_target[batch_index, action_indices] = reward + \
-                self.gamma * q_next[batch_index, max_actions.astype(int)] * done
-            
-            absError = abs(q_pred[batch_index, action_indices] - q_target[batch_index, action_indices])
-            
-            #_ = self.q_eval.fit(state, q_target, verbose=0)
-            _ = self.q_eval.fit(state, q_target, verbose=0, sample_weight=batchISWeights)
+        @tf.function(input_signature=[batch, tf.TensorSpec([None], tf.int64), vector, batch, vector, vector])
+        def train_step(state, action, reward, new_state, done, weights):
+            q_next = q_target(new_state, training=False) # What reward would target model expect for each poss. action
+            max_actions = tf.argmax(q_eval(new_state, training=False), axis=1) # What action would the live model suggest
+            target = reward + gamma * tf.gather(q_next, max_actions, batch_dims=1) * done
 
-            self.memory.batchUpdate(batchIndexes, absError)
+            with tf.GradientTape() as tape:
+                q_pred = tf.gather(q_eval(state, training=True), action, batch_dims=1)
+                # Every other action matches its target, so the mse is just this error / n_actions
+                loss = tf.reduce_mean(tf.square(target - q_pred) / n_actions * weights)
+            gradients = tape.gradient(loss, q_eval.trainable_variables)
+            q_eval.optimizer.apply_gradients(zip(gradients, q_eval.trainable_variables))
+            return tf.abs(target - q_pred)
 
-            self.update_epsilon()
-            self.epsilon_step += 1
-            if self.memory.mem_count % self.replace_target == 0:
-                self.update_network_parameters()
-            kback.clear_session()
-        return
+        return train_step
 
     def update_epsilon(self):
         # self.epsilon = self.epsilon*self.epsilon_dec if self.epsilon > \
@@ -127,25 +272,47 @@ class DDQNAgent:
         Update QTarget with the weights of QEval model
         """
         self.q_target.set_weights(self.q_eval.get_weights())
+        self.target_synced_at = self.memory.mem_count
         return
 
     def save_model(self, ep_no):
-        self.q_eval.save(self.model_file)
-        treeIndex = self.memory.save_buffer(self.param_fname)
+        # Save under a temporary name first, so a crash never leaves a partial model file
+        root, ext = os.path.splitext(self.model_file)
+        self.q_eval.save(root + '.tmp' + ext)
+        os.replace(root + '.tmp' + ext, self.model_file)
+
+        if self.checkpointer is not None:
+            with self.memory_lock:
+                self.checkpointer.save(self.memory, {'ep_no': int(ep_no), 'epsilon_step': int(self.epsilon_step),
+                                                     'mem_count': int(self.memory.mem_count),
+                                                     'tree_pointer': int(self.memory.sumTree.dataPointer)})
+            return
+
+        with self.memory_lock:
+            treeIndex = self.memory.save_buffer(self.param_fname)
 
         steps = np.array([ep_no, self.epsilon_step, self.memory.mem_count, treeIndex])
         np.save(self.param_fname + '_steps', steps)
         return
 
     def load_model(self):
-        steps = np.load(self.param_fname + '_steps.npy')
-        ep_no = steps[0] + 1 # Increment as we are starting a new episode
-        self.epsilon_step = steps[1]
-        self.memory.mem_count = steps[2]
-        treeIndex = steps[3]
-
-        self.q_eval = load_model(self.model_file)
-        self.memory.load_buffer(self.param_fname, treeIndex)
+        self._q_eval = load_model(self.model_file)
+        self.train_step = None
+        self.policy_stale = True
+
+        if self.checkpointer is not None and self.checkpointer.exists():
+            meta = self.checkpointer.load(self.memory)
+            ep_no = meta['ep_no'] + 1 # Increment as we are starting a new episode
+            self.epsilon_step = meta['epsilon_step']
+        else:
+            # Saved with np.save (also used before there were checkpoints)
+            steps = np.load(self.param_fname + '_steps.npy')
+            ep_no = steps[0] + 1 # Increment as we are starting a new episode
+            self.epsilon_step = steps[1]
+            if self.memory.storage is None: # Memory-mapped storage keeps its counters in its own header
+                self.memory.mem_count = steps[2]
+            treeIndex = steps[3]
+            self.memory.load_buffer(self.param_fname, treeIndex)
         self.update_epsilon()
         
         self.update_network_parameters()
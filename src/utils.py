@@ -1,5 +1,6 @@
 import pygame
 import math
+import numpy as np
 
 
 def scale_image(img, factor):
@@ -22,6 +23,61 @@ def rotate_center(image, center, angle):
     return rotated_image, new_rect.topleft
 
 
+def surface_to_grid(surface, threshold=127):
+    """
+    Convert a surface into a 2D boolean occupancy array indexed as [y, x].
+    Matches pygame.mask.from_surface - pixels with alpha above threshold are set.
+    """
+    return pygame.surfarray.array_alpha(surface).T > threshold
+
+
+def distance_transform(grid):
+    """
+    Euclidean distance from every pixel of a 2D boolean array to the nearest set pixel
+    (0 on set pixels). Exact - computed as a separable pass of squared distances along
+    each axis in turn.
+    """
+    squared = np.where(grid, 0.0, np.inf)
+    for axis in (0, 1):
+        squared = _squared_distance_pass(squared, axis)
+    return np.sqrt(squared)
+
+
+def _squared_distance_pass(squared, axis):
+    """
+    For each element return min over k of (squared[i + k] + k**2) along one axis.
+    Stops early once k**2 exceeds every distance found so far (ignoring lines with
+    nothing set, which stay infinite).
+    """
+    result = squared.copy()
+    source = np.moveaxis(squared, axis, 0)
+    target = np.moveaxis(result, axis, 0) # View, so writes land in result
+    reachable = np.isfinite(source).any(axis=0)
+    for k in range(1, source.shape[0]):
+        if k % 16 == 0 and k * k > target[:, reachable].max():
+            break
+        np.minimum(target[k:], source[:-k] + k * k, out=target[k:])
+        np.minimum(target[:-k], source[k:] + k * k, out=target[:-k])
+    return result
+
+
+def segments_cross(a1, a2, b1, b2):
+    """
+    Whether the segment from a1 to a2 crosses the segment from b1 to b2 (touching counts).
+    Points are arrays with x, y in the last axis, so many segments can be tested at once.
+    """
+    a1, a2, b1, b2 = (np.asarray(p, dtype=np.float64) for p in (a1, a2, b1, b2))
+
+    def side(p, q, r):
+        # Sign of the cross product says which side of line p-q the point r is on
+        return (q[..., 0]-p[..., 0])*(r[..., 1]-p[..., 1]) - (q[..., 1]-p[..., 1])*(r[..., 0]-p[..., 0])
+
+    a1_side, a2_side = side(b1, b2, a1), side(b1, b2, a2)
+    b1_side, b2_side = side(a1, a2, b1), side(a1, a2, b2)
+    collinear = (a1_side == 0) & (a2_side == 0)
+    return (a1_side * a2_side <= 0) & (b1_side * b2_side <= 0) & ~collinear
+
+
 def distance_between_points(point1, point2):
     """
     Given the coordinates of two points (given as a tuple),
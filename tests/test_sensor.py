@@ -0,0 +1,61 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+from src.Cars import PlayerCar
+from src.Environment import load_track_border
+from src.Sensor import Sensor, DistanceFieldSensor, BakedSensor, bake_sensor_table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def track_border():
+    cwd = os.getcwd()
+    os.chdir(ROOT) # Images are loaded relative to the repository root
+    try:
+        yield load_track_border()
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='module')
+def baked_sensors(track_border, tmp_path_factory):
+    # The table as baked by main.py bake-sensors, with the default angle step
+    fname = str(tmp_path_factory.mktemp('sensors') / 'sensor_table')
+    bake_sensor_table(track_border, PlayerCar.START_POS, fname=fname)
+    return BakedSensor(track_border, fname=fname)
+
+
+def drivable_poses(sensors, samples, seed=0):
+    """
+    Random poses on pixels covered by the baked table, at any angle.
+    """
+    rng = np.random.default_rng(seed)
+    ys, xs = np.nonzero(np.asarray(sensors.pixel_index) >= 0)
+    picks = rng.integers(len(xs), size=samples)
+    return np.column_stack([xs[picks] + rng.random(samples) - 0.5, ys[picks] + rng.random(samples) - 0.5,
+                            rng.uniform(0, 360, samples)])
+
+
+def test_baked_matches_distance_field(track_border, baked_sensors):
+    field_sensors = DistanceFieldSensor(track_border)
+    x, y, angle = drivable_poses(baked_sensors, 50000).T
+    baked_x, baked_y = baked_sensors.cast(x, y, angle)
+    field_x, field_y = field_sensors.cast(x, y, angle)
+    assert np.array_equal(baked_x, field_x) and np.array_equal(baked_y, field_y)
+
+
+def test_baked_within_check_sensors_tolerance(track_border, baked_sensors):
+    # Same comparison and tolerance as main.py check-sensors --backend baked
+    mask_sensors = Sensor(track_border, track_border, debug=False)
+    errors = []
+    for x, y, angle in drivable_poses(baked_sensors, 300, seed=1):
+        car = SimpleNamespace(x=x, y=y, angle=angle)
+        expected = mask_sensors.beam_distances(car)
+        if None in expected:
+            continue
+        errors.append(np.abs(np.array(baked_sensors.beam_distances(car)) - expected))
+    assert len(errors) > 200
+    assert np.max(errors) <= 1.5